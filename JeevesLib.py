@@ -8,13 +8,21 @@
 """
 
 from env.VarEnv import VarEnv
-from env.PolicyEnv import PolicyEnv
-from env.PathVars import PathVars
+from env.PolicyEnv import PolicyEnv, concretizeDetached, PinnedViewerException
+from env.PathVars import PathVars, BitEnv, emptyEnv
 from env.WritePolicyEnv import WritePolicyEnv
 from smt.Z3 import Z3
 from fast.AST import Facet, fexpr_cast, Constant, Var, Not, FExpr, Unassigned, FObject, jeevesState
-from eval.Eval import partialEval
+from eval.Eval import partialEval, create_facet
+import eval.BatchEval
+import fast.AST
+import smt.Z3
+import smt.Parallel
+import atexit
 import copy
+import gc
+import threading
+from multiprocessing.pool import ThreadPool
 
 def init():
   """Initialization function for Jeeves library.
@@ -24,7 +32,19 @@ def init():
   """
   jeevesState.init()
 
-  # TODO this needs to be GC'ed somehow
+def collect():
+  """Frees the labels no value refers to any more, with their policies.
+
+  Labels are only held weakly, so most are freed as soon as they become
+  unreachable. This also frees the ones their own policies refer to, drops
+  what freed labels leave behind, and makes their ids available to new labels.
+
+  :returns: int - the number of label ids freed.
+  """
+  jeevesState.evalcache.clear()
+  gc.collect()
+  jeevesState.policyenv.collect()
+  return fast.AST.labelIds.recycle()
 
 def supports_jeeves(f):
   f.__jeeves = 0
@@ -44,22 +64,30 @@ def mkLabel(varName = "", uniquify=True):
 
 @supports_jeeves
 def doesLabelExist(varName):
-  return varName in jeevesState.all_labels
+  return jeevesState.findLabel(varName) is not None
 
 @supports_jeeves
 def getLabel(varName):
-  return jeevesState.all_labels[varName]
+  label = jeevesState.findLabel(varName)
+  if label is None:
+    raise KeyError(varName)
+  return label
 
 @supports_jeeves
-def restrict(varLabel, pred, use_empty_env=False):
+def restrict(varLabel, pred, use_empty_env=False, policyKey=None):
   """Associates a policy with a label.
 
   :param varLabel: Label to associate with policy.
   :type varLabel: string
   :param pred: Policy: function taking output channel and returning Boolean result.
   :type pred: T -> bool, where T is the type of the output channel
+  :param policyKey: Optional hashable key covering all the data pred reads.
+    A label made again with the same name, in a later scope, is decided from
+    the label cache (see setViewerKey) only if each of its policies had a
+    key, and the same one.
+  :type policyKey: hashable
   """
-  jeevesState.policyenv.restrict(varLabel, pred, use_empty_env)
+  jeevesState.policyenv.restrict(varLabel, pred, use_empty_env, policyKey)
 
 @supports_jeeves
 def mkSensitive(varLabel, vHigh, vLow):
@@ -71,13 +99,41 @@ def mkSensitive(varLabel, vHigh, vLow):
   :type vHigh: T
   :param vLow: Low-confidentiality facet for other viewers.
   :type vLow: T
+
+  With a pinned viewer (see pin_viewer), only the facet that viewer sees is
+  kept when the label can be decided.
   """
 
   if isinstance(varLabel, Var):
+    value = jeevesState.policyenv.pinnedValue(varLabel)
+    if value is not None:
+      return fexpr_cast(vHigh if value else vLow)
     return Facet(varLabel, fexpr_cast(vHigh), fexpr_cast(vLow))
   else:
     return JeevesLib.jif(varLabel, lambda:vHigh, lambda:vLow)
 
+def pin_viewer(ctxt):
+  """Pins the output channel, for code that only shows its values to one
+  viewer, such as the logged-in user of a web request.
+
+  Labels are then decided for the viewer when they are used, by mkSensitive
+  and by jeevesdb reads, and values only keep the facet the viewer sees.
+  Labels whose policies depend on each other in ways the solver has to
+  decide are left faceted. Concretizing for another viewer raises
+  PinnedViewerException, and so does a new policy that does not hold for a
+  label already decided HIGH. Pins made in a scope end with it.
+
+  :param ctxt: Output channel (viewer).
+  :type ctxt: T, where policies have type T -> bool
+  """
+  jeevesState.policyenv.pin(ctxt)
+
+def unpin_viewer():
+  """Goes back to keeping every facet. Values made while pinned keep only
+  the facet of the pinned viewer.
+  """
+  jeevesState.policyenv.unpin()
+
 @supports_jeeves
 def concretize(ctxt, v):
   """Projects out a single value to the viewer.
@@ -88,11 +144,237 @@ def concretize(ctxt, v):
   :type v: FExpr
   :returns: The concrete (non-faceted) version of T under the policies in the environment.
   """
-  return jeevesState.policyenv.concretizeExp(ctxt, v, jeevesState.pathenv.getEnv())
+  return jeevesState.policyenv.concretizeExp(ctxt, v, jeevesState.pathenv.getBitEnv())
+
+@supports_jeeves
+def concretizeMany(ctxt, values):
+  """Concretizes all the values in a structure at once.
+
+  The labels of all the values are decided together, with one solver.
+
+  :param ctxt: Output channel (viewer).
+  :type ctxt: T, where policies have type T -> bool
+  :param values: Values to concretize, possibly in nested dicts, lists and
+    tuples.
+  :returns: The same structure with every faceted value replaced by its
+    concrete version. Values that occur several times share their result.
+  """
+  return jeevesState.policyenv.concretizeMany(ctxt, values, jeevesState.pathenv.getBitEnv())
+
+@supports_jeeves
+def concretizeForViewers(viewers, v):
+  """Concretizes a value for each of several viewers.
+
+  Viewers whose policies give the same results share one solver run.
+
+  :param viewers: Output channels (viewers); they must be hashable.
+  :type viewers: list of T, where policies have type T -> bool
+  :param v: Value to concretize.
+  :type v: FExpr
+  :returns: dict - the concrete version of v for each viewer.
+  """
+  return jeevesState.policyenv.concretizeForViewers(viewers, v, jeevesState.pathenv.getBitEnv())
+
+@supports_jeeves
+def concretizeInProcesses(ctxt, v, processes=None):
+  """Concretizes a value with many labels, such as a large JList2, deciding
+  its labels in a pool of worker processes.
+
+  The policies are evaluated here. The labels left to the solver are split
+  into groups that do not constrain each other, and the groups are decided in
+  the workers, which are only sent their constraints as SMT-LIB text. The
+  result is the same as concretize's.
+
+  :param ctxt: Output channel (viewer).
+  :type ctxt: T, where policies have type T -> bool
+  :param v: Value to concretize.
+  :type v: FExpr
+  :param processes: Number of worker processes, by default the number of
+    CPUs. A different number replaces the pool.
+  :type processes: int
+  :returns: The concrete version of v.
+  """
+  pool, processes = smt.Parallel.processPool(processes)
+  return jeevesState.policyenv.concretizeInProcesses(ctxt, v,
+    jeevesState.pathenv.getBitEnv(), pool, processes * 4)
+
+def workerPool(processes=None):
+  """The pool of threads that concretizeAsync and concretizeParallel use,
+  made on first use.
+
+  :param processes: Number of threads, by default the number of CPUs. Only
+    used when the pool is made.
+  :type processes: int
+  :returns: ThreadPool - the pool.
+  """
+  global _workers
+  with _workersLock:
+    if _workers is None:
+      _workers = ThreadPool(processes)
+    return _workers
+
+def setWorkerThreads(processes):
+  """Replaces the pool of worker threads with one of the given size, once the
+  work given to the old one is done.
+
+  :param processes: Number of threads.
+  :type processes: int
+  """
+  global _workers
+  with _workersLock:
+    old, _workers = _workers, ThreadPool(processes)
+  if old is not None:
+    _closePool(old)
+
+# Wait for the threads of a pool to end, and for their Z3 contexts to be freed.
+def _closePool(pool):
+  pool.close()
+  pool.join()
+  smt.Z3.awaitEndedContexts()
+
+# At exit, free the Z3 objects of every thread while Z3 can still free them.
+def _shutdown():
+  if _workers is not None:
+    _closePool(_workers)
+  jeevesState.releaseSolvers()
+  gc.collect()
+
+_workers = None
+_workersLock = threading.Lock()
+atexit.register(_shutdown)
+
+@supports_jeeves
+def concretizeAsync(ctxt, v):
+  """Concretizes a value in a worker thread.
+
+  Every worker thread has its own solvers, in its own Z3 context, and Z3 does
+  not hold the interpreter lock while it solves, so concretizations run in
+  parallel. The value is concretized under the policies and the path
+  condition at the time of the call.
+
+  :param ctxt: Output channel (viewer).
+  :type ctxt: T, where policies have type T -> bool
+  :param v: Value to concretize.
+  :type v: FExpr
+  :returns: AsyncResult - its get() method returns the concrete value.
+  """
+  solver_state = jeevesState.policyenv.getDetachedSolverState(ctxt)
+  return workerPool().apply_async(concretizeDetached,
+    (solver_state, fexpr_cast(v), jeevesState.pathenv.getBitEnv()))
+
+@supports_jeeves
+def concretizeParallel(requests):
+  """Concretizes several values, each for its own viewer, in the worker
+  threads (see concretizeAsync).
+
+  :param requests: Pairs of a viewer and a value to concretize for it.
+  :type requests: list of (T, FExpr)
+  :returns: list - the concrete values, in order.
+  """
+  results = [concretizeAsync(ctxt, v) for ctxt, v in requests]
+  return [r.get() for r in results]
+
+@supports_jeeves
+def evalBatch(v, assignments):
+  """Evaluates a value under many label assignments at once.
+
+  Uses vectorized NumPy operations when NumPy is available.
+
+  :param v: Value to evaluate.
+  :type v: FExpr
+  :param assignments: Label assignments, each a dictionary from labels to bool.
+  :type assignments: list of dict
+  :returns: list - the value of v under each assignment, in order.
+  """
+  return eval.BatchEval.evalBatch(fexpr_cast(v), assignments)
+
+def setViewerKey(viewerKey, capacity=1024):
+  """Caches decided labels across concretizations, per viewer, until a
+  policy in their component changes.
+
+  :param viewerKey: Maps a viewer to a hashable key, or to None to not cache
+    for that viewer. Viewers with the same key must be treated the same by
+    every policy.
+  :type viewerKey: function
+  :param capacity: Maximum number of cached labels.
+  :type capacity: int
+  """
+  jeevesState.policyenv.setViewerKey(viewerKey, capacity)
+
+def labelCacheStats():
+  """Reports on the label cache of the current thread.
+
+  :returns: dict - the number of hits and misses, its size and its capacity.
+  """
+  return jeevesState.policyenv.labelCache.stats()
+
+def componentStats():
+  """Reports on the connected components of the labels in the current thread,
+  which the solver decides separately.
+
+  :returns: dict - the number of labels and of components, and the size of
+    the largest component.
+  """
+  return jeevesState.policyenv.components.stats()
+
+def setPolicyMemo(enabled=True):
+  """Reuses the predicate each policy returns for a viewer key (see
+  setViewerKey) instead of calling the policy again.
+
+  :param enabled: Whether to memoize policies.
+  :type enabled: bool
+  """
+  jeevesState.policyenv.setPolicyMemo(enabled)
+
+def invalidatePolicies(varName):
+  """Forgets the memoized predicates of a label's policies, and the values
+  cached for it. Call this when the data the policies read changes, also when
+  the label does not exist at the time, if it may be made again with the same
+  name.
+
+  :param varName: Name of the label.
+  :type varName: str
+  """
+  jeevesState.policyenv.invalidatePolicies(varName)
+
+def policyMemoStats():
+  """Reports on the policy memo of the current thread.
+
+  :returns: dict - the number of policy calls saved and of labels with
+    memoized predicates.
+  """
+  policyenv = jeevesState.policyenv
+  return {'saved': policyenv.policyCallsSaved,
+          'labels': len(policyenv.policyMemo)}
+
+def threadStats():
+  """Reports on the Jeeves state of each thread. The state of a thread is
+  released when the thread ends.
+
+  :returns: dict - for each thread id, the thread's name and the number of
+    labels, policies, path conditions, eval cache entries, pooled solvers and
+    scopes in its state.
+  """
+  return jeevesState.threadSizes()
+
+def clearEvalCache():
+  """Empties the partial evaluation memo table of the current thread.
+
+  Call this at the start of a request, so that entries do not outlive it.
+  """
+  jeevesState.evalcache.clear()
+
+def evalCacheStats():
+  """Reports on the partial evaluation memo table of the current thread.
+
+  :returns: dict - the number of hits and misses since it was last cleared,
+    its size and its capacity.
+  """
+  return jeevesState.evalcache.stats()
 
 @supports_jeeves
 def jif(cond, thn_fn, els_fn):
-  condTrans = partialEval(fexpr_cast(cond), jeevesState.pathenv.getEnv())
+  condTrans = partialEval(fexpr_cast(cond), jeevesState.pathenv.getBitEnv())
   if condTrans.type != bool:
     raise TypeError("jif must take a boolean as a condition")
   return jif2(condTrans, thn_fn, els_fn)
@@ -111,7 +393,8 @@ def jif2(cond, thn_fn, els_fn):
     with NegativeVariable(cond.cond):
       els = jif2(cond.els, thn_fn, els_fn)
 
-    return Facet(cond.cond, thn, els)
+    return create_facet(cond.cond, fexpr_cast(thn), fexpr_cast(els),
+      jeevesState.pathenv.getBitEnv())
 
   else:
     raise TypeError("jif condition must be a constant or a var")
@@ -143,17 +426,19 @@ def jnot(f):
     return not f
 
 @supports_jeeves
-def jassign(old, new, base_env={}):
+def jassign(old, new, base_env=emptyEnv):
+  if isinstance(base_env, dict):
+    base_env = BitEnv.fromDict(base_env)
   res = new
   for vs in jeevesState.pathenv.conditions:
     (var, val) = (vs.var, vs.val)
-    if var.name not in base_env:
+    if not base_env.has(var):
       if val:
         res = Facet(var, res, old)
       else:
         res = Facet(var, old, res)
   if isinstance(res, FExpr):
-    return partialEval(res, {}, True)
+    return partialEval(res, emptyEnv, True)
   else:
     return res
 
@@ -176,21 +461,53 @@ def jhas(lst, v):
   return jhasElt(lst, lambda x: x == v)
 '''
 
+class scope:
+  """Runs a block, such as the handling of a request, with its own labels,
+  policies and path conditions.
+
+  The block starts with the labels and policies of the enclosing code, and
+  those it adds are dropped when it ends. Values that outlive the block must
+  only depend on labels made outside it or promoted.
+
+  Usage::
+
+    with JeevesLib.scope():
+      ...
+  """
+  def __enter__(self):
+    jeevesState.pushScope()
+    return self
+  def __exit__(self, type, value, traceback):
+    jeevesState.popScope()
+
+def promote(label):
+  """Keeps a label made in a scope, with its policies, after the scope ends.
+
+  :param label: Label made in the innermost scope.
+  :type label: Var
+  """
+  if not jeevesState.scopes:
+    return
+  jeevesState.policyenv.promote(label)
+  jeevesState.scopes[-1][3][label.name] = label
+
 class PositiveVariable:
   def __init__(self, var):
     self.var = var
   def __enter__(self):
-    jeevesState.pathenv.push(self.var, True)
+    self.pathenv = jeevesState.pathenv
+    self.pathenv.push(self.var, True)
   def __exit__(self, type, value, traceback):
-    jeevesState.pathenv.pop()
+    self.pathenv.pop()
 
 class NegativeVariable:
   def __init__(self, var):
     self.var = var
   def __enter__(self):
-    jeevesState.pathenv.push(self.var, False)
+    self.pathenv = jeevesState.pathenv
+    self.pathenv.push(self.var, False)
   def __exit__(self, type, value, traceback):
-    jeevesState.pathenv.pop()
+    self.pathenv.pop()
 
 def liftTuple(t):
   t = fexpr_cast(t)
@@ -207,7 +524,7 @@ class Namespace:
   def __init__(self, kw, funcname):
     self.__dict__.update(kw)
     self.__dict__['_jeeves_funcname'] = funcname
-    self.__dict__['_jeeves_base_env'] = jeevesState.pathenv.getEnv()
+    self.__dict__['_jeeves_base_env'] = jeevesState.pathenv.getBitEnv()
 
   def __setattr__(self, attr, value):
     self.__dict__[attr] = jassign(self.__dict__.get(attr, Unassigned("variable '%s' in %s" % (attr, self._jeeves_funcname))), value, self.__dict__['_jeeves_base_env'])
@@ -233,13 +550,14 @@ def jmap(iterable, mapper):
   if isinstance(iterable, FObject) and isinstance(iterable.v, JList2):
     return jmap_jlist2(iterable.v, mapper)
 
-  iterable = partialEval(fexpr_cast(iterable), jeevesState.pathenv.getEnv())
+  iterable = partialEval(fexpr_cast(iterable), jeevesState.pathenv.getBitEnv())
   return FObject(JList(jmap2(iterable, mapper)))
 def jmap2(iterator, mapper):
   if isinstance(iterator, Facet):
-    if jeevesState.pathenv.hasPosVar(iterator.cond):
+    pathenv = jeevesState.pathenv
+    if pathenv.hasPosVar(iterator.cond):
       return jmap2(iterator.thn, mapper)
-    if jeevesState.pathenv.hasNegVar(iterator.cond):
+    if pathenv.hasNegVar(iterator.cond):
       return jmap2(iterator.els, mapper)
     with PositiveVariable(iterator.cond):
       thn = jmap2(iterator.thn, mapper)
@@ -259,15 +577,16 @@ def jmap2(iterator, mapper):
 
 def jmap_jlist2(jlist2, mapper):
   ans = JList2([])
-  env = jeevesState.pathenv.getEnv()
+  ans.labels = dict(jlist2.labels)
+  env = jeevesState.pathenv.getBitEnv()
   for i, e in jlist2.l:
     popcount = 0
     for vname, vval in e.iteritems():
-      if vname not in env:
-        v = getLabel(vname)
+      v = jlist2.labels[vname]
+      if not env.has(v):
         jeevesState.pathenv.push(v, vval)
         popcount += 1
-      elif env[vname] != vval:
+      elif env.get(v) != vval:
         break
     else:
       ans.l.append((mapper(i), e))
@@ -324,18 +643,22 @@ class JList2:
       self.l = [(i, {}) for i in l]
     else:
       raise NotImplementedError
+    # The entries only name their labels, so the labels are kept here.
+    self.labels = {}
   
   def append(self, val):
     self.l.append((val, jeevesState.pathenv.getEnv()))
+    for vs in jeevesState.pathenv.conditions:
+      self.labels[vs.var.name] = vs.var
 
   def eval(self, env):
-    return [i for i,e in self.l if all(env[getLabel(v)] == e[v] for v in e)]
+    return [i for i,e in self.l if all(env[self.labels[v]] == e[v] for v in e)]
 
   def vars(self):
     all_vars = set()
     for _, e in self.l:
       all_vars.update(set(e.keys()))
-    return {getLabel(v) for v in all_vars}
+    return {self.labels[v] for v in all_vars}
 
   def convert_to_jlist1(self):
     all_vars = [v.name for v in self.vars()]
@@ -347,7 +670,7 @@ class JList2:
         cur_e2 = dict(cur_e)
         cur_e1[all_vars[i]] = True
         cur_e2[all_vars[i]] = False
-        return Facet(getLabel(all_vars[i]),
+        return Facet(self.labels[all_vars[i]],
             rec(cur_e1, i+1), rec(cur_e2, i+1))
     return JList(rec({}, 0))
 
@@ -369,7 +692,7 @@ def jfun(f, *args, **kw):
   if hasattr(f, '__jeeves'):
     return f(*args, **kw)
   else:
-    env = jeevesState.pathenv.getEnv()
+    env = jeevesState.pathenv.getBitEnv()
     if len(args) > 0:
       return jfun2(f, args, kw, 0, partialEval(fexpr_cast(args[0]), env), [])
     else:
@@ -382,7 +705,7 @@ def jfun(f, *args, **kw):
 
 def jfun2(f, args, kw, i, arg, args_concrete):
   if isinstance(arg, Constant) or isinstance(arg, FObject):
-    env = jeevesState.pathenv.getEnv()
+    env = jeevesState.pathenv.getBitEnv()
     if i < len(args) - 1:
       return jfun2(f, args, kw, i+1, partialEval(fexpr_cast(args[i+1]), env), tuple(list(args_concrete) + [arg.v]))
     else:
@@ -408,7 +731,7 @@ def jfun3(f, kw, it, key, val, args_concrete, kw_concrete):
       next_key = next(it)
     except StopIteration:
       return fexpr_cast(f(*args_concrete, **kw_c))
-    env = jeevesState.pathenv.getEnv()
+    env = jeevesState.pathenv.getBitEnv()
     return jfun3(f, kw, it, next_key, partialEval(fexpr_cast(kw[next_key]), env), args_concrete, kw_c)
   else:
     it1, it2 = tee(it)
@@ -419,7 +742,7 @@ def jfun3(f, kw, it, key, val, args_concrete, kw_concrete):
     return Facet(val.cond, thn, els)
 
 def evalToConcrete(f):
-    g = partialEval(fexpr_cast(f), jeevesState.pathenv.getEnv())
+    g = partialEval(fexpr_cast(f), jeevesState.pathenv.getBitEnv())
     if isinstance(g, Constant):
       return g.v
     elif isinstance(g, FObject):
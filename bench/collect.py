@@ -0,0 +1,48 @@
+'''
+Soak benchmark for label collection.
+
+Each round stands for a request: it makes a batch of labels with policies, some
+of which refer to their own label, concretizes a value over them and drops
+them. Reports, every few rounds, the labels and policies the environment
+still holds, the number of label ids in use and the time to concretize, with
+and without a JeevesLib.collect() after each round.
+
+Run from the repository root with: python -m bench.collect
+'''
+import time
+
+import JeevesLib
+import fast.AST
+
+def request(size):
+  labels = [JeevesLib.mkLabel("r") for _ in xrange(size)]
+  for i, label in enumerate(labels):
+    if i % 2:
+      JeevesLib.restrict(label, lambda ctxt, label=label: ctxt or label)
+    else:
+      JeevesLib.restrict(label, lambda ctxt: ctxt)
+  value = sum(JeevesLib.mkSensitive(label, 1, 0) for label in labels)
+  start = time.time()
+  JeevesLib.concretize(True, value)
+  return time.time() - start
+
+def run(rounds, size, collect):
+  JeevesLib.init()
+  policyenv = JeevesLib.jeevesState.policyenv
+  print "collect: %s" % collect
+  print "%6s %8s %8s %8s %10s" % ("round", "labels", "policies", "ids",
+    "time (ms)")
+  for r in xrange(1, rounds + 1):
+    t = request(size)
+    if collect:
+      JeevesLib.collect()
+    if r % (rounds / 5) == 0:
+      print "%6d %8d %8d %8d %10.2f" % (r, len(JeevesLib.jeevesState.all_labels),
+        len(policyenv.policies), len(fast.AST.labelIds), t * 1000)
+
+def main(rounds=500, size=20):
+  run(rounds, size, False)
+  run(rounds, size, True)
+
+if __name__ == '__main__':
+  main()
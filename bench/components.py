@@ -0,0 +1,51 @@
+'''
+Benchmark for deciding the components of the labels separately.
+
+Groups of ten labels where each label may only be HIGH when two others of its
+group are not both HIGH, so every label is decided by the solver and the
+groups are the components. Each component is decided in a solver frame of its
+own, so the time per label should stay flat as the number of groups grows.
+The labels are then concretized again with a label cache, which decides
+nothing, and once more after a new policy in one group, which only decides
+that group again.
+
+Run from the repository root with: python -m bench.components
+'''
+import time
+
+import JeevesLib
+
+def timed(fn):
+  start = time.time()
+  fn()
+  return time.time() - start
+
+def setUp(groups, size=10):
+  JeevesLib.init()
+  values = []
+  for _ in xrange(groups):
+    labels = [JeevesLib.mkLabel('l') for _ in xrange(size)]
+    for i, label in enumerate(labels):
+      a = labels[(i + 1) % size]
+      b = labels[(i + 3) % size]
+      JeevesLib.restrict(label, lambda _, a=a, b=b:
+        JeevesLib.jnot(JeevesLib.jand(lambda: a, lambda: b)))
+      values.append(JeevesLib.mkSensitive(label, 1, 0))
+  return values
+
+def main(sizes=(25, 50, 100, 200), viewer=3):
+  print "%8s %10s %8s %10s %8s %10s" % ("labels", "components", "largest",
+    "time (s)", "cached", "one group")
+  for groups in sizes:
+    values = setUp(groups)
+    JeevesLib.setViewerKey(lambda ctxt: ctxt, 2 * len(values))
+    t = timed(lambda: JeevesLib.concretizeMany(viewer, values))
+    stats = JeevesLib.componentStats()
+    cached = timed(lambda: JeevesLib.concretizeMany(viewer, values))
+    JeevesLib.restrict(values[0].cond, lambda _: True)
+    one = timed(lambda: JeevesLib.concretizeMany(viewer, values))
+    print "%8d %10d %8d %10.3f %8.3f %10.3f" % (len(values),
+      stats['components'], stats['largest'], t, cached, one)
+
+if __name__ == '__main__':
+  main()
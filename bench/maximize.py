@@ -0,0 +1,48 @@
+'''
+Benchmark for the solver's label maximization.
+
+Each label may only be HIGH when the one before it is LOW, so no label can be
+resolved without the solver. Concretizes a value over all the labels with the
+'pushpop' and 'optimize' resolutions, and reports the time and the number of
+solver checks of each.
+
+Run from the repository root with: python -m bench.maximize
+'''
+import time
+
+import JeevesLib
+from fast.AST import Facet, Add
+
+# A balanced sum, so that the expression stays shallow.
+def total(values):
+  while len(values) > 1:
+    values = [Add(values[i], values[i+1]) if i + 1 < len(values) else values[i]
+              for i in xrange(0, len(values), 2)]
+  return values[0]
+
+def setUp(n):
+  JeevesLib.init()
+  labels = [JeevesLib.mkLabel("m") for _ in xrange(n)]
+  for prev, label in zip(labels, labels[1:]):
+    JeevesLib.restrict(label, lambda ctxt, prev=prev: JeevesLib.jnot(prev))
+  return total([Facet(label, 1, 0) for label in labels])
+
+def run(value, resolution):
+  policyenv = JeevesLib.jeevesState.policyenv
+  policyenv.setResolution(resolution)
+  state = policyenv.getNewSolverState(None)
+  start = time.time()
+  result = state.concretizeExp(value, {})
+  return result, time.time() - start, state.solver.checks
+
+def main(sizes=(10, 100, 1000)):
+  print "%6s %12s %8s %8s %8s" % ("labels", "resolution", "result",
+    "checks", "time (s)")
+  for n in sizes:
+    value = setUp(n)
+    for resolution in ('pushpop', 'optimize'):
+      result, t, checks = run(value, resolution)
+      print "%6d %12s %8d %8d %8.3f" % (n, resolution, result, checks, t)
+
+if __name__ == '__main__':
+  main()
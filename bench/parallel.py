@@ -0,0 +1,39 @@
+'''
+Benchmark for parallel concretization.
+
+Each label may only be HIGH when the one before it is LOW, so every label is
+decided by the solver. Concretizes a value over all the labels for a number
+of viewers, one after the other with JeevesLib.concretize and then with
+JeevesLib.concretizeParallel over pools of different sizes. The speedup is
+bounded by the number of CPUs.
+
+Run from the repository root with: python -m bench.parallel
+'''
+import multiprocessing
+import time
+
+import JeevesLib
+from bench.maximize import setUp
+
+def timed(fn):
+  start = time.time()
+  fn()
+  return time.time() - start
+
+def main(labels=300, viewers=16, sizes=(1, 2, 4, 8)):
+  value = setUp(labels)
+  requests = [(viewer, value) for viewer in xrange(viewers)]
+  print "%d CPUs, %d labels, %d viewers" % (multiprocessing.cpu_count(),
+    labels, viewers)
+  print "%12s %8s" % ("threads", "time (s)")
+  t = timed(lambda: [JeevesLib.concretize(ctxt, v) for ctxt, v in requests])
+  print "%12s %8.3f" % ("sequential", t)
+  for n in sizes:
+    JeevesLib.setWorkerThreads(n)
+    # Let every worker make its solver and Z3 context first.
+    JeevesLib.concretizeParallel(requests[:n])
+    t = timed(lambda: JeevesLib.concretizeParallel(requests))
+    print "%12d %8.3f" % (n, t)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,50 @@
+'''
+Benchmark for partialEval on deep facet trees.
+
+Builds chains of facets, one label per level, much deeper than the Python
+recursion limit, and reports the time per node. The time per node should stay
+roughly flat as the depth grows.
+
+Run from the repository root with: python -m bench.partialEval
+'''
+import sys
+import time
+
+import JeevesLib
+from fast.AST import Facet, Constant, Add
+from eval.Eval import partialEval
+
+def chain(labels):
+  f = Constant(0)
+  for i, l in enumerate(labels):
+    f = Facet(l, Constant(i), f)
+  return f
+
+# A value updated once under every label, as a long ProtectedRef history
+# produces: each update guards the previous value with a new label.
+def history(labels):
+  f = Constant(0)
+  for i, l in enumerate(labels):
+    f = Facet(l, Add(Constant(i), Constant(1)), f)
+  return f
+
+def timeIt(fn, *args):
+  start = time.time()
+  fn(*args)
+  return time.time() - start
+
+def main(sizes=(1000, 2000, 4000, 8000, 16000)):
+  JeevesLib.init()
+  print "recursion limit: %d" % sys.getrecursionlimit()
+  print "%8s %12s %12s %12s" % ("depth", "chain (us)", "history (us)", "join (us)")
+  for n in sizes:
+    labels = [JeevesLib.mkLabel("b") for _ in xrange(n)]
+    c = chain(labels)
+    h = history(labels)
+    tc = timeIt(partialEval, c)
+    th = timeIt(partialEval, h)
+    tj = timeIt(partialEval, Add(c, Constant(1)))
+    print "%8d %12.2f %12.2f %12.2f" % (n, tc * 1e6 / n, th * 1e6 / n, tj * 1e6 / n)
+
+if __name__ == '__main__':
+  main()
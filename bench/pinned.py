@@ -0,0 +1,59 @@
+'''
+Benchmark for pinning the viewer.
+
+Renders a page listing papers, with a title that some viewers may not see and
+an author that may only be shown with the title, once with every facet and
+concretization at the end, and once with the viewer pinned before the values
+are made. Each row is built from the title and author with a few operations,
+as a template would. Reports the time to render and the number of labels left
+in the rows before concretization.
+
+Run from the repository root with: python -m bench.pinned
+'''
+import time
+
+import JeevesLib
+from fast.AST import fexpr_cast
+
+def labels(rows):
+  return sum(len(fexpr_cast(v).vars()) for row in rows for v in row.itervalues())
+
+def render(papers, viewer, pinned):
+  JeevesLib.init()
+  if pinned:
+    JeevesLib.pin_viewer(viewer)
+  rows = []
+  for i in xrange(papers):
+    title = JeevesLib.mkLabel('title')
+    author = JeevesLib.mkLabel('author')
+    JeevesLib.restrict(title, lambda ctxt, i=i: ctxt != i % 7)
+    JeevesLib.restrict(author, lambda ctxt, i=i, title=title:
+      JeevesLib.jand(lambda: title, lambda: ctxt != i % 5))
+    name = JeevesLib.mkSensitive(title, 'Paper %d' % i, 'Paper')
+    by = JeevesLib.mkSensitive(author, 'Author %d' % i, 'Anonymous')
+    anonymous = by == 'Anonymous'
+    rows.append({
+      'title': name,
+      'byline': name + ' by ' + by,
+      'anonymous': anonymous,
+      'link': JeevesLib.jif(anonymous, lambda: '', lambda i=i: '/paper/%d' % i),
+      'score': JeevesLib.jif(name == 'Paper', lambda: 0, lambda i=i: i % 10) * 10,
+    })
+  return rows, labels(rows), JeevesLib.concretizeMany(viewer, rows)
+
+def main(sizes=(250, 1000, 4000), viewer=3):
+  print "%8s %8s %10s %8s %10s" % ("papers", "labels", "time (s)",
+    "pinned", "time (s)")
+  for papers in sizes:
+    start = time.time()
+    _, count, expected = render(papers, viewer, False)
+    t = time.time() - start
+    start = time.time()
+    _, pinnedCount, result = render(papers, viewer, True)
+    pinnedTime = time.time() - start
+    assert result == expected
+    print "%8d %8d %10.3f %8d %10.3f" % (papers, count, t, pinnedCount,
+      pinnedTime)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,58 @@
+'''
+Benchmark for concretization in worker processes.
+
+A paper listing: a JList2 with a title and an author entry for each paper. An
+author may only be shown when the title is not, so the solver decides every
+author label. Concretizes the listing once with JeevesLib.concretize and then
+with JeevesLib.concretizeInProcesses over pools of different sizes. The
+papers do not constrain each other, so their labels can be decided in any
+worker; the speedup is bounded by the number of CPUs.
+
+Run from the repository root with: python -m bench.processes
+'''
+import multiprocessing
+import time
+
+import JeevesLib
+from fast.AST import FObject
+from JeevesLib import PositiveVariable
+
+def timed(fn):
+  start = time.time()
+  fn()
+  return time.time() - start
+
+def setUp(papers):
+  JeevesLib.init()
+  listing = JeevesLib.JList2()
+  for i in xrange(papers):
+    title = JeevesLib.mkLabel('title')
+    author = JeevesLib.mkLabel('author')
+    JeevesLib.restrict(title, lambda ctxt, i=i: ctxt != i % 7)
+    JeevesLib.restrict(author, lambda ctxt, title=title: JeevesLib.jnot(title))
+    with PositiveVariable(title):
+      listing.append('Paper %d' % i)
+    with PositiveVariable(author):
+      listing.append('Author %d' % i)
+  return FObject(listing)
+
+def main(papers=2000, viewer=3, sizes=(1, 2, 4, 8)):
+  print "%d CPUs, %d papers" % (multiprocessing.cpu_count(), papers)
+  print "%12s %8s" % ("processes", "time (s)")
+  # A new listing for every run, so that none hits the caches of another.
+  value = setUp(papers)
+  expected = []
+  t = timed(lambda: expected.append(JeevesLib.concretize(viewer, value)))
+  print "%12s %8.3f" % ("sequential", t)
+  for n in sizes:
+    # Start the workers first.
+    JeevesLib.concretizeInProcesses(viewer, setUp(1), n)
+    value = setUp(papers)
+    result = []
+    t = timed(lambda: result.append(
+      JeevesLib.concretizeInProcesses(viewer, value, n)))
+    assert result == expected
+    print "%12d %8.3f" % (n, t)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,41 @@
+'''
+Benchmark for access to the per-thread Jeeves state.
+
+Compares looking an environment up in a dictionary keyed by
+threading.current_thread(), as JeevesState used to, with the threading.local
+behind jeevesState, through its property and through the state accessor.
+Also times jif on a faceted condition, which goes through the state for its
+path condition.
+
+Run from the repository root with: python -m bench.state
+'''
+import threading
+import timeit
+from collections import defaultdict
+
+import JeevesLib
+import env.PathVars
+from fast.AST import jeevesState
+
+def main(n=1000000):
+  JeevesLib.init()
+  keyed = defaultdict(env.PathVars.PathVars)
+  state = jeevesState.state
+  cases = [
+    ("thread-keyed dict", lambda: keyed[threading.current_thread()]),
+    ("jeevesState.pathenv", lambda: jeevesState.pathenv),
+    ("state.pathenv", lambda: state.pathenv),
+  ]
+  print "%20s %12s" % ("access", "ns per call")
+  for name, fn in cases:
+    t = min(timeit.repeat(fn, number=n, repeat=3))
+    print "%20s %12.1f" % (name, t / n * 1e9)
+
+  x = JeevesLib.mkLabel('x')
+  cond = JeevesLib.mkSensitive(x, True, False)
+  t = min(timeit.repeat(lambda: JeevesLib.jif(cond, lambda: 1, lambda: 0),
+    number=n / 100, repeat=3))
+  print "%20s %12.1f" % ("jif", t / (n / 100) * 1e9)
+
+if __name__ == '__main__':
+  main()
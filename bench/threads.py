@@ -0,0 +1,46 @@
+'''
+Load generator for the per-thread Jeeves state.
+
+Runs batches of short-lived threads, each of which makes labels and policies
+and concretizes a value, as a thread-per-request server would. After every
+batch, runs JeevesLib.collect() to recycle the ids of the labels the threads
+made, and reports how many thread states are still alive, the number of label
+ids in use and the resident memory of the process.
+
+Run from the repository root with: python -m bench.threads
+'''
+import os
+import threading
+
+import JeevesLib
+import fast.AST
+
+def request():
+  labels = [JeevesLib.mkLabel("t") for _ in xrange(10)]
+  for label in labels:
+    JeevesLib.restrict(label, lambda ctxt: ctxt)
+  JeevesLib.concretize(True,
+    sum(JeevesLib.mkSensitive(label, 1, 0) for label in labels))
+
+def rss():
+  with open('/proc/self/statm') as f:
+    pages = int(f.read().split()[1])
+  return pages * os.sysconf('SC_PAGE_SIZE') / 1024
+
+def main(batches=10, threads=500, concurrency=20):
+  JeevesLib.init()
+  print "%6s %8s %8s %8s %10s" % ("batch", "threads", "states", "ids",
+    "rss (kB)")
+  for b in xrange(1, batches + 1):
+    for _ in xrange(threads / concurrency):
+      running = [threading.Thread(target=request) for _ in xrange(concurrency)]
+      for t in running:
+        t.start()
+      for t in running:
+        t.join()
+    JeevesLib.collect()
+    print "%6d %8d %8d %8d %10d" % (b, b * threads,
+      len(JeevesLib.threadStats()), len(fast.AST.labelIds), rss())
+
+if __name__ == '__main__':
+  main()
@@ -64,6 +64,7 @@ def request_wrapper(view_fn):
     import time
 
     def real_view_fn(request):
+        JeevesLib.clearEvalCache()
         try:
             t1 = time.time()
             ans = view_fn(request)
@@ -85,12 +86,19 @@ def request_wrapper(view_fn):
 
             #print 'concretized is', concretize(context_dict['latest_title'])
 
-            r = render_to_response(template_name, RequestContext(request, context_dict))
+            try:
+                # Decide the labels of the whole context at once.
+                context_dict = concretizeState.concretizeMany(context_dict,
+                    JeevesLib.jeevesState.pathenv.getBitEnv())
+                r = render_to_response(template_name, RequestContext(request, context_dict))
+            finally:
+                concretizeState.release()
 
             t3 = time.time()
 
             logger.info("Jeeves time: %f" % (t2 - t1))
             logger.info("Concre time: %f" % (t3 - t2))
+            logger.info("Eval cache: %s" % JeevesLib.evalCacheStats())
 
             return r
 
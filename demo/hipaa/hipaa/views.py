@@ -60,6 +60,7 @@ def add_to_context(context_dict, request, template_name, profile, concretize):
 
 def request_wrapper(view_fn):
     def real_view_fn(request):
+        JeevesLib.clearEvalCache()
         try:
             ans = view_fn(request)
             template_name = ans[0]
@@ -79,7 +80,10 @@ def request_wrapper(view_fn):
 
             #print 'concretized is', concretize(context_dict['latest_title'])
 
-            return render_to_response(template_name, RequestContext(request, context_dict))
+            try:
+                return render_to_response(template_name, RequestContext(request, context_dict))
+            finally:
+                concretizeState.release()
 
         except Exception:
             import traceback
@@ -0,0 +1,39 @@
+from collections import OrderedDict
+
+'''
+A bounded table evicting the least recently used entry when it is full.
+It holds the partialEval results of a thread: keys are built by
+eval.Eval.partialEval, and the entries keep the evaluated expression alive, so
+the node ids in the keys stay valid. PolicyEnv also uses one for resolved
+labels.
+'''
+class EvalCache:
+  def __init__(self, capacity=4096):
+    self.capacity = capacity
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def lookup(self, key):
+    try:
+      value = self.entries.pop(key)
+    except KeyError:
+      self.misses += 1
+      return None
+    self.entries[key] = value
+    self.hits += 1
+    return value
+
+  def store(self, key, value):
+    self.entries[key] = value
+    if len(self.entries) > self.capacity:
+      self.entries.popitem(last=False)
+
+  def clear(self):
+    self.entries.clear()
+    self.hits = 0
+    self.misses = 0
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses,
+            'size': len(self.entries), 'capacity': self.capacity}
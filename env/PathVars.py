@@ -10,26 +10,117 @@ class VarSetting:
   def __str__(self):
     return "(%s, %s)" % (self.var.name, self.val)
 
+'''
+An immutable label assignment kept as two bitsets over label ids: bit i of
+decided is set when the label with id i has a value, and bit i of values holds
+that value. Assigning a label makes a new BitEnv from two integers instead of
+copying a dictionary.
+
+A BitEnv also holds the Vars it assigns, as a chain of (var, rest) pairs in
+labels, so that their ids are not recycled (see fast.AST.LabelIds) and given
+to other labels while it is in use, as by the base environments of models
+and namespaces.
+'''
+class BitEnv(object):
+  __slots__ = ('decided', 'values', 'labels')
+
+  def __init__(self, decided=0, values=0, labels=None):
+    self.decided = decided
+    self.values = values
+    self.labels = labels
+
+  # Convert a dictionary from label names to bools. Names without an id have
+  # no Var, so nothing can depend on them, and they are left out.
+  @staticmethod
+  def fromDict(d):
+    decided = 0
+    values = 0
+    labels = None
+    for name, val in d.iteritems():
+      if fast.AST.labelIds.find(name) is None:
+        continue
+      var = fast.AST.Var(name, uniquify=False)
+      bit = 1 << var.id
+      decided |= bit
+      if val:
+        values |= bit
+      labels = (var, labels)
+    return BitEnv(decided, values, labels)
+
+  def has(self, var):
+    return (self.decided >> var.id) & 1 == 1
+
+  def get(self, var):
+    return (self.values >> var.id) & 1 == 1
+
+  def assign(self, var, val):
+    bit = 1 << var.id
+    return BitEnv(self.decided | bit,
+      (self.values | bit) if val else (self.values & ~bit),
+      (var, self.labels))
+
+  # Name-based access, for code written against dictionary environments.
+  def __contains__(self, name):
+    i = fast.AST.labelIds.find(name)
+    return i is not None and (self.decided >> i) & 1 == 1
+
+  def __getitem__(self, name):
+    i = fast.AST.labelIds.find(name)
+    if i is None or (self.decided >> i) & 1 == 0:
+      raise KeyError(name)
+    return (self.values >> i) & 1 == 1
+
+  def __len__(self):
+    return bin(self.decided).count('1')
+
+  def toDict(self):
+    d = {}
+    decided = self.decided
+    i = 0
+    while decided:
+      if decided & 1:
+        d[fast.AST.labelIds.name(i)] = (self.values >> i) & 1 == 1
+      decided >>= 1
+      i += 1
+    return d
+
+emptyEnv = BitEnv()
+
 # TODO: Define your path variable environment, as well as manipulations, here.
 class PathVars:
   def __init__(self):
     self.conditions = []
+    # The conditions as bitsets, and their Vars as in BitEnv, with the
+    # previous ones saved for pop.
+    self.decided = 0
+    self.values = 0
+    self.labels = None
+    self.saved = []
 
   def push(self, var, value):
     assert type(var) == fast.AST.Var
     assert type(value) == bool
-    if VarSetting(var, not value) in self.conditions:
+    bit = 1 << var.id
+    if self.decided & bit and bool(self.values & bit) != value:
       raise Exception("Path condition for '%s' already set to '%s'" % (var, not value))
     self.conditions.append(VarSetting(var, value))
+    self.saved.append((self.decided, self.values, self.labels))
+    self.labels = (var, self.labels)
+    self.decided |= bit
+    if value:
+      self.values |= bit
+    else:
+      self.values &= ~bit
 
   def pop(self):
     self.conditions.pop()
+    self.decided, self.values, self.labels = self.saved.pop()
 
   def hasPosVar(self, var):
-    return VarSetting(var, True) in self.conditions
+    return (self.decided & self.values) >> var.id & 1 == 1
 
   def hasNegVar(self, var):
-    return VarSetting(var, False) in self.conditions
+    return (self.decided & ~self.values) >> var.id & 1 == 1
 
   def getPathFormula(self):
     c2 = [(vs.var if vs.val else fast.AST.Not(vs.var)) for vs in self.conditions]
@@ -37,3 +128,15 @@ class PathVars:
 
   def getEnv(self):
     return {vs.var.name : vs.val for vs in self.conditions}
+
+  def getBitEnv(self):
+    return BitEnv(self.decided, self.values, self.labels)
+
+  # A path starting with these conditions, for a scope (see JeevesLib.scope).
+  def copy(self):
+    path = PathVars()
+    path.conditions = list(self.conditions)
+    path.decided = self.decided
+    path.values = self.values
+    path.labels = self.labels
+    return path
@@ -2,41 +2,279 @@ import JeevesLib
 
 import fast.AST
 from collections import defaultdict
+import itertools
+import weakref
 from eval.Eval import partialEval
 from fast.AST import FExpr
+from env.PathVars import BitEnv, emptyEnv
+from env.EvalCache import EvalCache
 
-from smt.Z3 import Z3
+from smt.SMT import UnsatisfiableException
+import smt.Parallel
 
+# Raised for a viewer other than the pinned one, or for a policy that would
+# make a label decided HIGH for the pinned viewer LOW (see PolicyEnv.pin).
+class PinnedViewerException(Exception):
+    pass
+
+'''
+The solver state only asserts the policies that can affect the value being
+concretized: those of the labels the value mentions, of the labels on the path,
+and, transitively, of the labels their predicates mention. The policies of
+other labels are left pending and asserted by a later concretizeExp on the same
+state if they become relevant. A pending policy cannot change the result: its
+label does not occur in anything asserted, so it can be taken to be LOW.
+
+Labels are resolved without the solver when possible (see resolve). Z3 is only
+used for the labels left over, with the labels resolved to LOW fixed (see
+reopen).
+Labels that share no constraint cannot affect each other, so the solver decides
+each connected component of the labels (see LabelComponents) in a frame of its
+own, with only that component's constraints.
+
+Decided labels depend only on the viewer and the policies of their component,
+so with a cache (see PolicyEnv.setViewerKey) they are shared between solver
+states, keyed by the version of the component and cacheKey, the key of the
+viewer. Cached labels are taken as resolved without calling their policies.
+The cache is only used outside of any path condition.
+'''
 class SolverState:
-    def __init__(self, policies, ctxt):
-        self.solver = Z3()
+    def __init__(self, policies, ctxt, resolution='pushpop', cache=None,
+                 cacheKey=None, components=None):
+        self.solver = None
         self.result = {}
         self.ctxt = ctxt
+        self.resolution = resolution
+        self.cache = cache
+        self.cacheKey = cacheKey
+        self.caching = False
+        self.components = components if components is not None \
+            else LabelComponents()
 
-        self.policies = policies # NOT a copy
-        self.policies_index = 0
+        # The lists of policies of a scope and the ones around it, each with
+        # its index by label name (see PolicyEnv.policyLists). NOT copies.
+        # Policies are identified by the position of their list and their
+        # position in it.
+        self.policies = policies
+        self.asserted = set()
+        # The lengths of the lists when collect started (see added).
+        self.lengths = None
+
+        # The constraints of the relevant policies, with a label of each to
+        # find its component by, or None for constraints without labels.
+        self.constraints = []
+        self.constraint_labels = []
+        # The predicates of each label, partially evaluated on the path.
+        self.predicates = defaultdict(list)
+        # Labels the resolver gives up on, and the ones it has decided.
+        self.unresolvable = set()
+        self.resolved = {}
+        # Set by constraints that do not have the form label => predicate,
+        # which can force labels in either direction.
+        self.hard = False
 
     def concretizeExp(self, f, pathenv):
         f = fast.AST.fexpr_cast(f)
+        self.decide(f.vars(), pathenv)
+        return fast.AST.evalExpr(f, self.result)
 
-        while self.policies_index < len(self.policies):
-            label, policy = self.policies[self.policies_index]
-            self.policies_index += 1
+    '''
+    Concretize every faceted value in a structure of dicts, lists and tuples,
+    deciding the union of their labels in one pass. Returns the structure
+    with the faceted values replaced by their concrete values; a value or
+    container that occurs several times is concretized once, and the copies
+    share the result.
+    '''
+    def concretizeMany(self, values, pathenv):
+        vars_needed = set()
+        seen = set()
+        todo = [values]
+        while todo:
+            v = todo.pop()
+            if id(v) in seen:
+                continue
+            seen.add(id(v))
+            if isinstance(v, FExpr):
+                vars_needed.update(v.vars())
+            elif isinstance(v, dict):
+                todo.extend(v.itervalues())
+            elif isinstance(v, (list, tuple)):
+                todo.extend(v)
+        self.decide(vars_needed, pathenv)
+        return self.concretizeValue(values, {})
 
-            predicate = policy(self.ctxt) #predicate should be True if label can be HIGH
-            predicate_vars = predicate.vars()
-            constraint = partialEval(fast.AST.Implies(label, predicate), pathenv)
+    def concretizeValue(self, v, memo):
+        if id(v) in memo:
+            return memo[id(v)]
+        if isinstance(v, FExpr):
+            r = fast.AST.evalExpr(v, self.result)
+        elif isinstance(v, dict):
+            r = memo[id(v)] = {}
+            for key, x in v.iteritems():
+                r[key] = self.concretizeValue(x, memo)
+        elif isinstance(v, list):
+            r = memo[id(v)] = []
+            r.extend(self.concretizeValue(x, memo) for x in v)
+        elif isinstance(v, tuple):
+            r = tuple(self.concretizeValue(x, memo) for x in v)
+        else:
+            r = v
+        memo[id(v)] = r
+        return r
 
-            if constraint.type != bool:
-                raise ValueError("constraints must be bools")
-            self.solver.boolExprAssert(constraint)
+    # Decide the given labels, and the labels they depend on.
+    def decide(self, vars_needed, pathenv):
+        self.collect(vars_needed, pathenv)
+        self.solve(vars_needed)
+
+    # Evaluate the policies relevant to the given labels.
+    def collect(self, vars_needed, pathenv):
+        if isinstance(pathenv, dict):
+            pathenv = BitEnv.fromDict(pathenv)
+
+        self.lengths = [len(entries) for entries, _ in self.policies]
+        path = pathenv.toDict().keys()
+        self.unresolvable.update(path)
+        self.caching = self.cache is not None and not path
+        todo = [var.name for var in vars_needed] + path
+        while todo:
+            name = todo.pop()
+            if name in self.resolved:
+                continue
+            pending = self.pending(name)
+            if not pending:
+                continue
+            if self.caching:
+                value = self.cache.lookup(self.labelKey(name))
+                if value is not None:
+                    self.resolved[name] = value
+                    continue
+            for j, i in pending:
+                self.asserted.add((j, i))
+                label, policy = getPolicy(self.policies[j][0][i])
+                if label is None:
+                    continue
+                predicate = policy(self.ctxt) #predicate should be True if label can be HIGH
+                hard = not isinstance(label, fast.AST.Var) or pathenv.has(label)
+                if hard:
+                    constraint = partialEval(fast.AST.Implies(label, predicate), pathenv)
+                else:
+                    # The label is not on the path, so only the predicate needs
+                    # evaluating.
+                    evaluated = partialEval(predicate, pathenv)
+                    constraint = fast.AST.mkNode(fast.AST.Implies, label, evaluated)
+
+                if constraint.type != bool or not hard and evaluated.type != bool:
+                    raise ValueError("constraints must be bools")
+                names = [var.name for var in constraint.vars()]
+                self.components.union(names)
+                self.constraints.append(constraint)
+                self.constraint_labels.append(names[0] if names else None)
+                if hard:
+                    self.hard = True
+                    self.unresolvable.update(names)
+                else:
+                    self.predicates[label.name].append(evaluated)
+                todo.extend(names)
+                todo.extend(var.name for var in predicate.vars())
+                # A policy can restrict labels while it runs, for instance
+                # when it reads a row of jeevesdb with labels of its own.
+                todo.extend(self.added())
 
-        if not self.solver.check():
+    # The positions of the policies of a label not asserted yet. A label may
+    # be an expression over several labels (see WritePolicyEnv).
+    def pending(self, name):
+        return [(j, i) for j, (_, index) in enumerate(self.policies)
+                for i in index.get(name, ()) if (j, i) not in self.asserted]
+
+    # The names of the labels of the policies added since the last call.
+    def added(self):
+        names = []
+        for j, (entries, _) in enumerate(self.policies):
+            for entry in entries[self.lengths[j]:]:
+                label, _ = getPolicy(entry)
+                if label is not None:
+                    names.extend(var.name for var in label.vars())
+            self.lengths[j] = len(entries)
+        return names
+
+    def labelKey(self, name):
+        return (self.components.version(name), self.cacheKey, name)
+
+    # Identifies the policy outcomes collected so far. The constraints and
+    # predicates are hash-consed, so states with the same signature have the
+    # same constraints and decide their labels the same way.
+    def signature(self):
+        return (tuple(id(c) for c in self.constraints),
+                tuple((name, tuple(id(p) for p in predicates))
+                      for name, predicates in sorted(self.predicates.iteritems())),
+                tuple(sorted(self.resolved.iteritems())),
+                tuple(sorted(self.unresolvable)))
+
+    # Decide the given labels, with their policies collected.
+    def solve(self, vars_needed):
+        concretized = set(self.result)
+        remaining = self.resolveAll(vars_needed)
+        if not remaining and not self.hard:
+            return
+        remaining = self.reopen(vars_needed, remaining, concretized)
+        for labels, constraints in self.groupByComponent(remaining):
+            self.solveComponent(labels, constraints)
+
+    # Split the labels to decide and the constraints by component. With hard
+    # constraints every component is returned, so that all are checked.
+    def groupByComponent(self, remaining):
+        groups = {}
+        for var in remaining:
+            root = self.components.find(var.name)
+            groups.setdefault(root, ([], []))[0].append(var)
+        for constraint, name in zip(self.constraints, self.constraint_labels):
+            if name is None:
+                if not fast.AST.evalExpr(constraint, {}):
+                    raise UnsatisfiableException("Constraints not satisfiable")
+                continue
+            group = groups.get(self.components.find(name))
+            if group is None and self.hard:
+                group = groups.setdefault(self.components.find(name), ([], []))
+            if group is not None:
+                group[1].append(constraint)
+        return groups.values()
+
+    '''
+    Decide labels of one component in a frame with only its constraints and
+    the labels of the component decided so far. When caching, the rest of the
+    labels in the constraints are decided too, after the given ones, so that
+    the cached labels of a component always come from one assignment.
+    '''
+    def solveComponent(self, labels, constraints):
+        if self.solver is None:
+            self.solver = JeevesLib.jeevesState.solverpool.acquire()
+        self.solver.push()
+        others = []
+        seen = set(labels)
+        for constraint in constraints:
+            self.solver.boolExprAssert(constraint)
+            for var in constraint.vars():
+                if var in seen:
+                    continue
+                seen.add(var)
+                value = self.result.get(var, self.resolved.get(var.name))
+                if value is not None:
+                    self.solver.boolExprAssert(var if value else fast.AST.Not(var))
+                else:
+                    others.append(var)
+        # Constraints of the form label => predicate hold with the label LOW,
+        # so only hard ones can be unsatisfiable.
+        if self.hard and not self.solver.isSatisfiable():
             raise UnsatisfiableException("Constraints not satisfiable")
 
-        vars_needed = f.vars()
-        for var in vars_needed:
-            if var not in self.result:
+        caching = self.caching and not self.hard
+        if caching:
+            labels = labels + others
+        if self.resolution == 'optimize':
+            self.maximize(labels)
+        else:
+            for var in labels:
                 self.solver.push()
                 self.solver.boolExprAssert(var)
                 if self.solver.isSatisfiable():
@@ -45,38 +283,660 @@ class SolverState:
                     self.solver.pop()
                     self.solver.boolExprAssert(fast.AST.Not(var))
                     self.result[var] = False
-        
-        assert self.solver.check()
+        self.solver.popAll()
+        if caching:
+            for var in labels:
+                self.cache.store(self.labelKey(var.name), self.result[var])
+
+    # Decide the labels the resolver can, and return the others.
+    def resolveAll(self, vars_needed):
+        for var in vars_needed:
+            if var not in self.result:
+                value = self.resolve(var.name, set())
+                if value is not None:
+                    self.result[var] = value
+        return [var for var in vars_needed if var not in self.result]
+
+    '''
+    A label the resolver makes HIGH is only HIGH for want of a constraint that
+    makes it LOW, and the constraints left to the solver can have one, which
+    the solver may find or not depending on the order it decides labels in.
+    So in the components left to the solver, the labels resolved to HIGH are
+    decided by the solver again, the needed ones with the others, and only
+    the ones resolved to LOW, which no assignment can make HIGH, are kept.
+    The labels in concretized, given out before, keep their values. Returns
+    the labels of vars_needed to decide, oldest first, so that the solver
+    favours the labels made first whatever order vars_needed is in.
+    '''
+    def reopen(self, vars_needed, remaining, concretized):
+        roots = set(self.components.find(var.name) for var in remaining)
+        if self.hard:
+            roots.update(self.components.find(name)
+                         for name in self.constraint_labels if name is not None)
+        reopened = set()
+        for name, value in self.resolved.items():
+            if value and self.components.find(name) in roots:
+                del self.resolved[name]
+                self.unresolvable.add(name)
+                reopened.add(name)
+        remaining = set(remaining)
+        for var in vars_needed:
+            if var.name in reopened and var not in concretized:
+                del self.result[var]
+                remaining.add(var)
+        return sorted(remaining, key=lambda var: var.serial)
+
+    # Decide the given labels as solve does, but with the components left to
+    # the solver decided in the processes of pool (see smt.Parallel). The
+    # labels decided so far are substituted into the constraints first.
+    def solveInProcesses(self, vars_needed, pool, jobs):
+        concretized = set(self.result)
+        remaining = self.resolveAll(vars_needed)
+        if not remaining and not self.hard:
+            return
+        remaining = self.reopen(vars_needed, remaining, concretized)
+        decided = dict(self.resolved)
+        decided.update((var.name, value) for var, value in self.result.iteritems())
+        decided = BitEnv.fromDict(decided)
+        groups = []
+        for labels, constraints in self.groupByComponent(remaining):
+            evaluated = []
+            for constraint in constraints:
+                constraint = partialEval(constraint, decided)
+                if isinstance(constraint, fast.AST.Constant):
+                    if not constraint.v:
+                        raise UnsatisfiableException("Constraints not satisfiable")
+                    continue
+                evaluated.append(constraint)
+            groups.append((evaluated, [var.name for var in labels]))
+        values = smt.Parallel.decide(groups, pool, jobs, self.hard)
+        for var in remaining:
+            self.result[var] = values[var.name]
+
+    # Decide a label as resolve does, collecting its policies first.
+    def resolveLabel(self, var):
+        if var.name not in self.resolved:
+            self.collect([var], emptyEnv)
+        return self.resolve(var.name, set())
+
+    '''
+    Decide a label without the solver, if its predicates are monotone in the
+    labels they mention and those labels can be decided first. For such
+    labels the assignment that makes the most labels HIGH is unique, and it is
+    what the solver finds whatever order it decides them in: a label is HIGH
+    exactly when all of its predicates hold with their labels decided. Labels
+    on a cycle of dependencies, or with predicates that are not monotone, give
+    None and are left to the solver.
+    '''
+    def resolve(self, name, visiting):
+        if name in self.resolved:
+            return self.resolved[name]
+        if name in self.unresolvable or name in visiting:
+            return None
+        visiting.add(name)
+        value = True
+        for predicate in self.predicates.get(name, ()):
+            if not isMonotone(predicate):
+                value = None
+                break
+            env = {}
+            for var in predicate.vars():
+                env[var] = self.resolve(var.name, visiting)
+                if env[var] is None:
+                    value = None
+                    break
+            if value is None:
+                break
+            if not fast.AST.evalExpr(predicate, env):
+                value = False
+                break
+        visiting.discard(name)
+        if value is None:
+            self.unresolvable.add(name)
+        else:
+            self.resolved[name] = value
+            if self.caching:
+                self.cache.store(self.labelKey(name), value)
+        return value
+
+    # Decide the labels as the push/pop loop does, in one solver call.
+    def maximize(self, remaining):
+        for var, value in zip(remaining, self.solver.maximizeInOrder(remaining)):
+            self.result[var] = value
+            self.solver.boolExprAssert(var if value else fast.AST.Not(var))
+
+    # Give the solver back to the pool. The state can still be used; it then
+    # takes another solver and asserts everything again.
+    def release(self, failed=False):
+        if self.solver is not None:
+            JeevesLib.jeevesState.solverpool.release(self.solver, failed)
+            self.solver = None
+
+'''
+Whether a partially evaluated predicate can only become true, never false, when
+one of its labels goes from LOW to HIGH. This checks that at every facet the
+LOW branch is False or the HIGH branch is True, which is enough for the
+predicates policies are usually written as.
+'''
+def isMonotone(f):
+    todo = [f]
+    while todo:
+        f = todo.pop()
+        if isinstance(f, fast.AST.Facet):
+            if not (f.thn is f.els
+                    or isinstance(f.els, fast.AST.Constant) and not f.els.v
+                    or isinstance(f.thn, fast.AST.Constant) and f.thn.v):
+                return False
+            todo.append(f.thn)
+            todo.append(f.els)
+        elif not isinstance(f, fast.AST.Constant):
+            return False
+    return True
+
+'''
+The label and the policy of an entry of PolicyEnv.policies, or None for the
+label if it has been collected or moved to another scope.
+'''
+def getPolicy(entry):
+    ref, i = entry
+    label = ref()
+    if label is None:
+        return None, None
+    return label, label.__dict__['_policies'][i]
+
+# Stands for the weak reference of an entry whose label has moved out.
+def noLabel():
+    return None
+
+versions = itertools.count()
+
+'''
+A union-find of label names, joining the labels that occur in a constraint
+together, so that each set is a connected component of the labels. It grows
+as solver states collect constraints. Each component has a version, drawn from
+versions, that changes when its policies change or it is joined with another.
+A label alone in its component whose policies were all given a policyKey is
+decided by its own policies only, and they read only what their keys cover.
+Its version is made of its name, the keys and the stamp of the last
+invalidatePolicies for it instead, so that a label made again in another scope
+with the same name and keys, as jeevesdb makes the labels of a row, gets the
+same version, and the label cache can be used for it.
+
+The components of a scope read through to those of the enclosing scope, base,
+which they never change: what the scope joins or touches is kept in its own
+tables, which shadow those of base.
+'''
+class LabelComponents(object):
+    def __init__(self, base=None):
+        self.base = base
+        self.parent = {}
+        # The sizes of components with more than one label, and the versions
+        # of the components, by root.
+        self.sizes = {}
+        self.versionOf = {}
+        # The cache keys of the policies added to each label, in order.
+        self.keys = {}
+
+    def parentOf(self, name):
+        parent = self.parent.get(name)
+        if parent is None and self.base is not None:
+            parent = self.base.parentOf(name)
+        return parent
 
-        return f.eval(self.result)
+    def sizeOf(self, root):
+        size = self.sizes.get(root)
+        if size is None and self.base is not None:
+            size = self.base.sizeOf(root)
+        return size or 1
 
+    def keysOf(self, name):
+        keys = self.keys.get(name)
+        if keys is None and self.base is not None:
+            keys = self.base.keysOf(name)
+        return keys or ()
+
+    def rootVersion(self, root):
+        version = self.versionOf.get(root)
+        if version is None and self.base is not None:
+            version = self.base.rootVersion(root)
+        return version
+
+    def find(self, name):
+        root = self.parentOf(name)
+        if root is None:
+            self.parent[name] = name
+            return name
+        if root == name:
+            return root
+        while True:
+            up = self.parentOf(root)
+            if up == root:
+                break
+            root = up
+        while name != root:
+            up = self.parentOf(name)
+            if up != root:
+                self.parent[name] = root
+            name = up
+        return root
+
+    def union(self, names):
+        roots = set(self.find(name) for name in names)
+        if len(roots) < 2:
+            return
+        roots = sorted(roots, key=lambda root: -self.sizeOf(root))
+        root = roots[0]
+        size = self.sizeOf(root)
+        for other in roots[1:]:
+            self.parent[other] = root
+            size += self.sizeOf(other)
+            self.sizes.pop(other, None)
+            self.versionOf.pop(other, None)
+        self.sizes[root] = size
+        self.versionOf[root] = next(versions)
+
+    def version(self, name):
+        root = self.find(name)
+        version = self.rootVersion(root)
+        if version is None:
+            version = self.versionOf[root] = next(versions)
+        return version
+
+    # Give the component of the label a new version.
+    def touch(self, name):
+        self.versionOf[self.find(name)] = next(versions)
+
+    # Record the policyKey of a policy added to the label, None for a policy
+    # without one, and give its component a new version.
+    def restricted(self, name, stamp, key):
+        keys = self.keys[name] = self.keysOf(name) + (key,)
+        root = self.find(name)
+        if root == name and self.sizeOf(root) == 1 and None not in keys:
+            self.versionOf[root] = (name, keys, stamp)
+        else:
+            self.versionOf[root] = next(versions)
+
+    # The names of the labels, with those of base.
+    def names(self):
+        names = set(self.parent)
+        if self.base is not None:
+            names.update(self.base.names())
+        return names
+
+    # Drop the labels for which isLive is false. The others keep their
+    # components, and the components their versions; the tables of base are
+    # copied, so that the result no longer reads through to it.
+    def collect(self, isLive):
+        parent = {}
+        sizes = {}
+        versionOf = {}
+        keys = {}
+        roots = {}
+        for name in self.names():
+            if not isLive(name):
+                continue
+            if self.keysOf(name):
+                keys[name] = self.keysOf(name)
+            old = self.find(name)
+            root = roots.setdefault(old, name)
+            parent[name] = root
+            if root != name:
+                sizes[root] = sizes.get(root, 1) + 1
+            elif self.rootVersion(old) is not None:
+                versionOf[root] = self.rootVersion(old)
+        self.base = None
+        self.parent = parent
+        self.sizes = sizes
+        self.versionOf = versionOf
+        self.keys = keys
+
+    def stats(self):
+        names = self.names()
+        roots = [name for name in names if self.parentOf(name) == name]
+        return {'labels': len(names), 'components': len(roots),
+                'largest': max([self.sizeOf(root) for root in roots] or [0])}
+
+'''
+Concretize f with a solver state, and give its solver back to the pool of the
+current thread.
+'''
+def concretizeWith(solver_state, f, pathenv):
+    try:
+        result = solver_state.concretizeExp(f, pathenv)
+    except:
+        solver_state.release(True)
+        raise
+    solver_state.release()
+    return result
+
+'''
+Concretize f with a solver state from PolicyEnv.getDetachedSolverState, in the
+current thread, with the environment of the state as the thread's policy
+environment while it runs.
+'''
+def concretizeDetached(solver_state, f, pathenv):
+    state = JeevesLib.jeevesState.state
+    saved, state.policyenv = state.policyenv, solver_state.policyenv
+    try:
+        return concretizeWith(solver_state, f, pathenv)
+    finally:
+        state.policyenv = saved
+
+'''
+Policies are kept by the labels they restrict, so that a label and its
+policies can be collected together once no value refers to the label, even
+when the policies refer to it. The environment only holds the labels weakly,
+except for labels that are expressions over several labels.
+'''
 class PolicyEnv:
   def __init__(self):
-    self.labels = []
+    self.labels = weakref.WeakValueDictionary()
+    # Weak references to the labels, in the order policies were added to
+    # them, with the index of each policy in its label, and the positions of
+    # the entries by the names of their labels.
     self.policies = []
+    self.index = defaultdict(list)
+    self.compoundLabels = []
+    self.resolution = 'pushpop'
+    # The components of the labels, with the versions the label cache is
+    # keyed by. Versions are drawn from a global counter, so that scopes can
+    # share the label cache.
+    self.components = LabelComponents()
+    # Stamps of the last invalidatePolicies for each label name, drawn from
+    # the same counter and shared with the scopes (see LabelComponents).
+    self.stamps = {}
+    self.viewerKey = None
+    self.labelCache = EvalCache(1024)
+    # Predicates returned by policies, by label name and then by policy and
+    # viewer key (see setPolicyMemo).
+    self.memoizePolicies = False
+    self.policyMemo = defaultdict(dict)
+    self.policyCallsSaved = 0
+    self.policyCount = 0
+    self.parent = None
+    # Decides labels for the pinned viewer, if there is one (see pin).
+    self.pinned = None
 
   def mkLabel(self, name="", uniquify=True):
     label = fast.AST.Var(name, uniquify)
-    self.labels.append(label)
+    self.labels[label.name] = label
     return label
 
   # policy is a function from context to bool which returns true
   # if the label is allowed to be HIGH
-  def restrict(self, label, policy, use_empty_env=False):
+  # policyKey, when given, is a hashable key that covers all the data the
+  # policy reads, so that the decision of a label made again with the same
+  # name and keys can be taken from the label cache (see LabelComponents).
+  def restrict(self, label, policy, use_empty_env=False, policyKey=None):
+    if not use_empty_env and JeevesLib.jeevesState.pathenv.conditions:
+      policyKey = None
     pcFormula = fast.AST.Constant(True) if use_empty_env else JeevesLib.jeevesState.pathenv.getPathFormula()
-    self.policies.append((label, lambda ctxt :
-      fast.AST.Implies(
+    predicate = lambda ctxt : fast.AST.Implies(
         pcFormula,
         fast.AST.fexpr_cast(policy(ctxt)),
       )
-    ))
+    label = fast.AST.fexpr_cast(label)
+    if isinstance(label, fast.AST.Var):
+      self.checkPinned(label, predicate)
+      predicate = self.memoizedPolicy(label.name, self.policyCount, predicate)
+    else:
+      self.compoundLabels.append(label)
+    self.policyCount += 1
+    policies = label.__dict__.setdefault('_policies', [])
+    self.addEntry((weakref.ref(label), len(policies)), label)
+    policies.append(predicate)
+    for var in label.vars():
+      self.components.restricted(var.name, self.stamps.get(var.name),
+        policyKey)
+
+  def addEntry(self, entry, label):
+    for var in label.vars():
+      self.index[var.name].append(len(self.policies))
+    self.policies.append(entry)
+
+  def memoizedPolicy(self, name, index, predicate):
+    def memoized(ctxt):
+      key = self.viewerKey(ctxt) \
+        if self.memoizePolicies and self.viewerKey is not None else None
+      if key is None:
+        return predicate(ctxt)
+      memo = self.policyMemo[name]
+      r = memo.get((index, key))
+      if r is None:
+        r = memo[(index, key)] = predicate(ctxt)
+      else:
+        self.policyCallsSaved += 1
+      return r
+    return memoized
+
+  # Keep the predicate each policy returns for a viewer key (see
+  # setViewerKey) instead of calling the policy again for that key. The
+  # predicates of a label are kept until invalidatePolicies is called for it,
+  # so that must be done whenever the data its policies read changes.
+  def setPolicyMemo(self, enabled):
+    self.memoizePolicies = enabled
+    self.policyMemo.clear()
+
+  def invalidatePolicies(self, name):
+    self.policyMemo.pop(name, None)
+    self.stamps[name] = next(versions)
+    self.components.touch(name)
+    # Labels are decided for the pinned viewer again, for values made from
+    # now on.
+    if self.pinned is not None:
+      self.pin(self.pinned.ctxt)
+    if self.parent is not None:
+      self.parent.invalidatePolicies(name)
+
+  # The environment of a scope (see JeevesLib.scope): it reads through to
+  # the policies and components of this one, starts with its settings, and
+  # is dropped when the scope ends. Making it copies none of the policies.
+  def child(self):
+    env = PolicyEnv()
+    env.parent = self
+    env.resolution = self.resolution
+    env.viewerKey = self.viewerKey
+    env.labelCache = self.labelCache
+    env.stamps = self.stamps
+    env.components = LabelComponents(self.components)
+    env.memoizePolicies = self.memoizePolicies
+    if self.pinned is not None:
+      env.pin(self.pinned.ctxt, self.pinned.resolved)
+    return env
+
+  # Move a label made in this scope, with its policies, to the parent scope.
+  # Its entries here are replaced in place, so that solver states reading
+  # the list do not see them twice.
+  def promote(self, label):
+    if self.parent.labels.get(label.name) is label:
+      return
+    for i, entry in enumerate(self.policies):
+      if entry[0]() is label:
+        self.parent.addEntry(entry, label)
+        self.policies[i] = (noLabel, 0)
+    self.parent.labels[label.name] = label
+    self.parent.components.touch(label.name)
+
+  # The lists of policies of the enclosing scopes and this one, outermost
+  # first, each with its index.
+  def policyLists(self):
+    lists = []
+    env = self
+    while env is not None:
+      lists.append((env.policies, env.index))
+      env = env.parent
+    return lists[::-1]
+
+  # Drop the entries of collected labels. Solver states already made keep
+  # the old list of policies.
+  def collect(self):
+    policies = self.policies
+    self.policies = []
+    self.index = defaultdict(list)
+    for entry in policies:
+      label = entry[0]()
+      if label is not None:
+        self.addEntry(entry, label)
+    for name in self.policyMemo.keys():
+      if name not in self.labels:
+        del self.policyMemo[name]
+    self.components.collect(fast.AST.labelIds.isLive)
+    if self.pinned is not None:
+      self.pin(self.pinned.ctxt, self.pinned.resolved)
+
+  # Cache resolved labels across solver states. viewerKey maps a viewer to a
+  # hashable key, or to None for viewers not to cache for; viewers with the
+  # same key must get the same result from every policy. Entries are kept
+  # for the current version of their component only, and at most capacity
+  # of them. A label made again under a name it had (mkLabel with uniquify
+  # off) is only decided from an entry of an earlier scope when each of its
+  # policies was given a policyKey (see restrict), and with the same keys.
+  def setViewerKey(self, viewerKey, capacity=1024):
+    self.viewerKey = viewerKey
+    self.labelCache = EvalCache(capacity)
+
+  # How the solver decides the labels it has to: 'pushpop' checks each label
+  # in its own scope, 'optimize' decides them all with one weighted
+  # optimization call (see Z3.maximizeInOrder).
+  def setResolution(self, resolution):
+    assert resolution in ('pushpop', 'optimize')
+    self.resolution = resolution
+
+  '''
+  Decide labels for one viewer as they are used, so that values can be made
+  with only the facet that viewer sees (see JeevesLib.pin_viewer). A label is
+  only decided once it has a policy, and only if the resolver can decide it
+  (see SolverState.resolve); the others are left to concretization. Labels
+  decided so far can be passed in as resolved. Until unpin, labels keep the
+  values decided for the viewer: a new policy that does not hold for a label
+  decided HIGH raises PinnedViewerException, and so does concretizing for
+  another viewer. After invalidatePolicies labels are decided again, for the
+  values made from then on.
+  '''
+  def pin(self, ctxt, resolved=None):
+    self.pinned = SolverState(self.policyLists(), ctxt, self.resolution,
+                              components=self.components)
+    if resolved is not None:
+      self.pinned.resolved.update(resolved)
+
+  def unpin(self):
+    self.pinned = None
+
+  # The value of the label for the pinned viewer, or None if it is left to
+  # concretization.
+  def pinnedValue(self, label):
+    if self.pinned is None or not label.__dict__.get('_policies'):
+      return None
+    return self.pinned.resolveLabel(label)
+
+  def checkPinned(self, label, policy):
+    state = self.pinned
+    if state is None or not state.resolved.get(label.name):
+      return
+    predicate = fast.AST.fexpr_cast(policy(state.ctxt))
+    env = {}
+    for var in predicate.vars():
+      env[var] = state.resolveLabel(var)
+      if env[var] is None:
+        break
+    else:
+      if fast.AST.evalExpr(predicate, env):
+        return
+    raise PinnedViewerException(
+      "policy does not hold for label '%s', already HIGH for the pinned viewer"
+      % label.name)
+
+  def checkViewer(self, ctxt):
+    viewer = self.pinned.ctxt
+    if not (ctxt is viewer or ctxt == viewer):
+      raise PinnedViewerException(
+        "cannot concretize for %r while pinned to %r" % (ctxt, viewer))
 
   def getNewSolverState(self, ctxt):
-    return SolverState(self.policies, ctxt)
+    key = self.viewerKey(ctxt) if self.viewerKey is not None else None
+    if key is None:
+      state = SolverState(self.policyLists(), ctxt, self.resolution,
+                          components=self.components)
+    else:
+      state = SolverState(self.policyLists(), ctxt, self.resolution,
+                          self.labelCache, key, self.components)
+    if self.pinned is not None:
+      self.checkViewer(ctxt)
+      state.resolved.update(self.pinned.resolved)
+    return state
+
+  # A solver state to be used from another thread (see concretizeDetached):
+  # it takes a copy of the policies, and does not use the label cache or the
+  # components, which are not shared between threads. Policies that restrict
+  # labels while they run add to the copy, through an environment of its own.
+  def getDetachedSolverState(self, ctxt):
+    env = PolicyEnv()
+    for entries, _ in self.policyLists():
+      for entry in entries:
+        label = entry[0]()
+        if label is not None:
+          env.addEntry(entry, label)
+    env.resolution = self.resolution
+    state = SolverState(env.policyLists(), ctxt, self.resolution)
+    state.policyenv = env
+    if self.pinned is not None:
+      self.checkViewer(ctxt)
+      state.resolved.update(self.pinned.resolved)
+    return state
 
   def concretizeExp(self, ctxt, f, pathenv):
+    return concretizeWith(self.getNewSolverState(ctxt), f, pathenv)
+
+  '''
+  Concretize a value for each of several viewers. The policies are evaluated
+  for every viewer, but the labels are only decided once for each group of
+  viewers whose policies come out the same.
+  '''
+  def concretizeForViewers(self, viewers, f, pathenv):
+    f = fast.AST.fexpr_cast(f)
+    vars_needed = f.vars()
+    groups = {}
+    states = {}
+    # The states are kept until the end, so that the node ids in their
+    # signatures stay valid.
+    collected = []
+    for viewer in viewers:
+      if viewer in states:
+        continue
+      solver_state = self.getNewSolverState(viewer)
+      solver_state.collect(vars_needed, pathenv)
+      collected.append(solver_state)
+      states[viewer] = groups.setdefault(solver_state.signature(), solver_state)
+
+    values = {}
+    for solver_state in groups.itervalues():
+      try:
+        solver_state.solve(vars_needed)
+        values[id(solver_state)] = fast.AST.evalExpr(f, solver_state.result)
+      except:
+        solver_state.release(True)
+        raise
+      solver_state.release()
+    return {viewer: values[id(solver_state)]
+            for viewer, solver_state in states.iteritems()}
+
+  def concretizeInProcesses(self, ctxt, f, pathenv, pool, jobs):
+    f = fast.AST.fexpr_cast(f)
+    vars_needed = f.vars()
+    solver_state = self.getNewSolverState(ctxt)
+    solver_state.collect(vars_needed, pathenv)
+    solver_state.solveInProcesses(vars_needed, pool, jobs)
+    return fast.AST.evalExpr(f, solver_state.result)
+
+  def concretizeMany(self, ctxt, values, pathenv):
     solver_state = self.getNewSolverState(ctxt)
-    return solver_state.concretizeExp(f, pathenv)
+    try:
+      result = solver_state.concretizeMany(values, pathenv)
+    except:
+      solver_state.release(True)
+      raise
+    solver_state.release()
+    return result
 
   """
   # Takes a context and an expression
@@ -0,0 +1,40 @@
+from smt.Z3 import Z3
+
+'''
+The Z3 solvers of one thread, kept for reuse between concretizations.
+A solver is handed out at its base scope. The solver state that takes it
+pushes a frame for its constraints, and releasing the solver pops it back to
+the base scope, or resets it if the concretization failed. At most capacity
+solvers are kept.
+'''
+class SolverPool:
+  def __init__(self, capacity=4):
+    self.capacity = capacity
+    self.free = []
+    self.created = 0
+    self.reused = 0
+
+  def acquire(self):
+    if self.free:
+      self.reused += 1
+      solver = self.free.pop()
+    else:
+      self.created += 1
+      solver = Z3()
+    solver.checks = 0
+    return solver
+
+  def release(self, solver, failed=False):
+    if failed:
+      solver.clear()
+    else:
+      solver.popAll()
+    if len(self.free) < self.capacity:
+      self.free.append(solver)
+
+  def clear(self):
+    self.free = []
+
+  def stats(self):
+    return {'created': self.created, 'reused': self.reused,
+            'free': len(self.free), 'capacity': self.capacity}
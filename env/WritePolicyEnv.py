@@ -1,11 +1,30 @@
 import JeevesLib
+import weakref
 
 # import fast.AST
 # from collections import defaultdict
 
 class WritePolicyEnv:
   def __init__(self):
-    self.writers = {}
+    # Held weakly, so that labels can be collected (see PolicyEnv).
+    self.writers = weakref.WeakKeyDictionary()
+    self.parent = None
+
+  # The environment of a scope (see JeevesLib.scope), which reads through to
+  # the writers of this one.
+  def child(self):
+    env = WritePolicyEnv()
+    env.parent = self
+    return env
+
+  # The writers of the innermost scope that maps the label, or None.
+  def findWriters(self, label):
+    env = self
+    while env is not None:
+      if env.writers.has_key(label):
+        return env.writers
+      env = env.parent
+    return None
 
   def mapPrimaryContext(self, ivar, ctxt):
     self.writers[ivar] = ctxt
@@ -14,8 +33,9 @@ class WritePolicyEnv:
   def addWritePolicy(self, label, policy, newWriter):
     # If the label is associated with a writer, then associate it with the
     # new write policies.
-    if self.writers.has_key(label):
-      ictxt = self.writers[label]
+    writers = self.findWriters(label)
+    if writers is not None:
+      ictxt = writers[label]
 
       # Make a new label mapped to the same writer.
       newLabel = JeevesLib.mkLabel(label.name)
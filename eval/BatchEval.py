@@ -0,0 +1,150 @@
+'''
+Evaluation of one expression under many label assignments at once.
+
+Label assignments are encoded as a boolean matrix with one row per assignment
+and one column per label, and every node is evaluated once for all the rows
+that reach it, as a vectorized NumPy operation. Facets and the short-circuiting
+boolean operators split the rows, so each subtree only sees the assignments
+under which eval would visit it. FObject leaves and unknown node types fall
+back to eval for the rows that reach them.
+
+Integer, float and boolean constants become typed arrays, so arithmetic over
+them is vectorized; other values are kept in object arrays, to which NumPy
+applies the Python operators. Integer operations that would overflow, where
+Python ints become longs, are redone on Python ints.
+
+NumPy is optional: without it evalBatch evaluates row by row.
+'''
+import operator
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from fast.AST import *
+
+# Operators that can be applied to whole arrays. The shift operators in the
+# AST use the in-place variants, which would overwrite their operand here.
+_arrayOps = { Add: operator.add, Sub: operator.sub, Mult: operator.mul
+            , Div: operator.div, Mod: operator.mod
+            , BitAnd: operator.and_, BitOr: operator.or_
+            , LShift: operator.lshift, RShift: operator.rshift
+            , Eq: operator.eq, Lt: operator.lt, LtE: operator.le
+            , Gt: operator.gt, GtE: operator.ge }
+_arithmeticOps = (Add, Sub, Mult, Div, Mod, LShift, RShift)
+
+def evalBatch(f, assignments):
+  assignments = list(assignments)
+  if numpy is None:
+    return [f.eval(env) for env in assignments]
+  batch = _Batch(assignments)
+  return batch.eval(f, numpy.arange(len(assignments))).tolist()
+
+def _objects(values):
+  a = numpy.empty(len(values), dtype=object)
+  for i, v in enumerate(values):
+    a[i] = v
+  return a
+
+def _isNumeric(a):
+  return a.dtype.kind in 'iufc'
+
+_int64Min = -2 ** 63
+
+# Apply the arithmetic operator of f to two int64 arrays, as Python would.
+def _intOp(f, left, right):
+  op = _arrayOps[type(f)]
+  if isinstance(f, (LShift, RShift)):
+    return op(left.astype(object), right.astype(object))
+  r = op(left, right)
+  if isinstance(f, Add):
+    overflow = ((left ^ r) & (right ^ r)) < 0
+  elif isinstance(f, Sub):
+    overflow = ((left ^ right) & (left ^ r)) < 0
+  elif isinstance(f, Mult):
+    overflow = numpy.abs(left.astype(float) * right) >= 2.0 ** 62
+  elif isinstance(f, Div):
+    overflow = (left == _int64Min) & (right == -1)
+  else:
+    return r
+  if overflow.any():
+    return op(left.astype(object), right.astype(object))
+  return r
+
+def _merge(n, mask, thn, els):
+  dtype = thn.dtype if thn.dtype == els.dtype else object
+  a = numpy.empty(n, dtype=dtype)
+  a[mask] = thn
+  a[~mask] = els
+  return a
+
+class _Batch:
+  def __init__(self, assignments):
+    self.assignments = assignments
+    # The columns of the labels, by the id of their Var, which the expression
+    # keeps alive: labels made again with the same name are other keys of the
+    # assignments.
+    self.columns = {}
+
+  # Every assignment must give a value to the labels the expression tests.
+  def column(self, label):
+    c = self.columns.get(id(label))
+    if c is None:
+      c = numpy.array([bool(env[label]) for env in self.assignments],
+            dtype=bool)
+      self.columns[id(label)] = c
+    return c
+
+  def fallback(self, f, rows):
+    return _objects([f.eval(self.assignments[i]) for i in rows])
+
+  def eval(self, f, rows):
+    n = len(rows)
+    if n == 0:
+      return numpy.empty(0, dtype=object)
+    if isinstance(f, Constant):
+      if isinstance(f.v, (bool, float)):
+        return numpy.full(n, f.v, dtype=type(f.v))
+      if type(f.v) is int:
+        return numpy.full(n, f.v, dtype=numpy.int64)
+      return _objects([f.v] * n)
+    elif isinstance(f, Var):
+      return self.column(f)[rows]
+    elif isinstance(f, Facet):
+      mask = self.column(f.cond)[rows]
+      return _merge(n, mask, self.eval(f.thn, rows[mask]),
+                    self.eval(f.els, rows[~mask]))
+    elif isinstance(f, Not):
+      return ~self.eval(f.sub, rows).astype(bool)
+    elif isinstance(f, (And, Or, Implies)):
+      left = self.eval(f.left, rows)
+      truth = left.astype(bool)
+      if isinstance(f, Implies):
+        left = ~truth
+      # The rows whose value is already decided by the left operand: the
+      # right one is only evaluated for the others.
+      mask = truth if isinstance(f, Or) else ~truth
+      return _merge(n, mask, left[mask], self.eval(f.right, rows[~mask]))
+    elif type(f) in _arrayOps:
+      left = self.eval(f.left, rows)
+      right = self.eval(f.right, rows)
+      if isinstance(f, _arithmeticOps):
+        # NumPy adds booleans as a logical or; Python adds them as ints.
+        if left.dtype == bool:
+          left = left.astype(numpy.int64 if _isNumeric(right) else object)
+        if right.dtype == bool:
+          right = right.astype(numpy.int64 if _isNumeric(left) else object)
+        # Numeric arrays divide by zero silently; eval raises. Object arrays
+        # apply the Python operator, which raises by itself, or formats a
+        # string with %.
+        if isinstance(f, (Div, Mod)) and _isNumeric(left) \
+            and _isNumeric(right) and (right == 0).any():
+          raise ZeroDivisionError("division by zero in %s" % type(f).__name__)
+        if left.dtype == numpy.int64 and right.dtype == numpy.int64:
+          return _intOp(f, left, right)
+      return _arrayOps[type(f)](left, right)
+    elif isinstance(f, Unassigned):
+      raise f.getException()
+    else:
+      return self.fallback(f, rows)
@@ -5,34 +5,128 @@ that in Python.
 '''
 
 from fast.AST import *
+from env.PathVars import BitEnv, emptyEnv
 
-def partialEval(f, env={}, unassignedOkay=False):
-  if isinstance(f, BinaryExpr):
-    left = partialEval(f.left, env, unassignedOkay)
-    right = partialEval(f.right, env, unassignedOkay)
-    return facetJoin(left, right, f.opr)
-  elif isinstance(f, UnaryExpr):
-    sub = partialEval(f.sub, env, unassignedOkay)
-    return facetApply(sub, f.opr)
-  elif isinstance(f, Constant):
-    return f
-  elif isinstance(f, Facet):
-    if f.cond.name in env:
-      return partialEval(f.thn, env, unassignedOkay) if env[f.cond.name] else partialEval(f.els, env, unassignedOkay)
-    else:
-      true_env = dict(env)
-      true_env[f.cond.name] = True
-      false_env = dict(env)
-      false_env[f.cond.name] = False
-      return create_facet(f.cond, partialEval(f.thn, true_env, unassignedOkay),
-                           partialEval(f.els, false_env, unassignedOkay))
-  elif isinstance(f, Var):
-    if f.name in env:
-      return Constant(env[f.name])
+'''
+Ordered facets.
+When enabled, partialEval and the facet combinators keep values as reduced
+ordered facet diagrams: along every path labels appear at most once and in a
+fixed global order, and no facet has identical branches. Together with
+hash-consing this makes the representation canonical, so two values are equal
+exactly when they are the same node.
+'''
+orderedFacets = False
+
+def setOrderedFacets(enabled):
+  global orderedFacets
+  orderedFacets = enabled
+
+# Memoization of partialEval, on by default.
+evalCaching = True
+
+def setEvalCaching(enabled):
+  global evalCaching
+  evalCaching = enabled
+
+# Labels are ordered by id, that is by when their names were first seen.
+def labelOrder(var):
+  return var.id
+
+# Work items for the explicit stacks of partialEval and facetJoin.
+_EVAL, _JOIN, _APPLY, _ELSE, _FACET = range(5)
+
+'''
+partialEval walks the expression with an explicit stack rather than by
+recursion, so its depth is not limited by the Python stack. The labels decided
+on the current path are kept as two bitsets in local integers: entering the
+then-branch of an undecided facet sets its bit, the else-branch clears the
+value bit, and leaving the facet clears the decided bit again.
+The environment is a BitEnv, or a dictionary from label names to bools.
+
+Results are memoized per thread in jeevesState.evalcache. The key is the node
+together with the part of the environment that assigns its free labels, so
+environments that differ only in labels the node does not mention share the
+entry, and the settings that change how results are built are part of it.
+Nodes over mutable containers are not memoized.
+'''
+def partialEval(f, env=emptyEnv, unassignedOkay=False):
+  if isinstance(env, dict):
+    env = BitEnv.fromDict(env)
+  if not evalCaching or not isinstance(f, (BinaryExpr, UnaryExpr, Facet)):
+    return _partialEval(f, env.decided, env.values, unassignedOkay)
+  mask = f.labelMask()
+  if mask is None:
+    return _partialEval(f, env.decided, env.values, unassignedOkay)
+  cache = jeevesState.evalcache
+  decided = env.decided & mask
+  key = (id(f), decided, env.values & decided, unassignedOkay, orderedFacets,
+    simplifyFacets)
+  entry = cache.lookup(key)
+  if entry is not None:
+    return entry[1]
+  r = _partialEval(f, env.decided, env.values, unassignedOkay)
+  cache.store(key, (f, r))
+  return r
+
+def _partialEval(f, decided, values, unassignedOkay):
+  if orderedFacets:
+    join = lambda left, right, opr: orderedJoin(left, right, opr, {})
+    apply = lambda sub, opr: orderedApply(sub, opr, {})
+    ite = lambda cond, thn, els: orderedIte(cond, thn, els, {})
+  else:
+    join = facetJoin
+    apply = facetApply
+    ite = create_facet
+
+  todo = [(_EVAL, f)]
+  results = []
+  while todo:
+    op, f = todo.pop()
+    if op == _EVAL:
+      if isinstance(f, BinaryExpr):
+        todo.append((_JOIN, f))
+        todo.append((_EVAL, f.right))
+        todo.append((_EVAL, f.left))
+      elif isinstance(f, UnaryExpr):
+        todo.append((_APPLY, f))
+        todo.append((_EVAL, f.sub))
+      elif isinstance(f, Facet):
+        bit = 1 << f.cond.id
+        if decided & bit:
+          todo.append((_EVAL, f.thn if values & bit else f.els))
+        else:
+          decided |= bit
+          values |= bit
+          todo.append((_FACET, f))
+          todo.append((_ELSE, f))
+          todo.append((_EVAL, f.thn))
+      elif isinstance(f, Var):
+        bit = 1 << f.id
+        if decided & bit:
+          results.append(mkConstant(bool(values & bit)))
+        else:
+          results.append(mkFacet(f, mkConstant(True), mkConstant(False)))
+      else:
+        results.append(partialEvalLeaf(f, unassignedOkay))
+    elif op == _JOIN:
+      right = results.pop()
+      results.append(join(results.pop(), right, f.opr))
+    elif op == _APPLY:
+      results.append(apply(results.pop(), f.opr))
+    elif op == _ELSE:
+      values &= ~(1 << f.cond.id)
+      todo.append((_EVAL, f.els))
     else:
-      return Facet(f, Constant(True), Constant(False))
+      decided &= ~(1 << f.cond.id)
+      els = results.pop()
+      results.append(ite(f.cond, results.pop(), els))
+  return results.pop()
+
+def partialEvalLeaf(f, unassignedOkay):
+  if isinstance(f, Constant):
+    return hashcons(f)
   elif isinstance(f, FObject):
-    return f
+    return hashcons(f)
   elif isinstance(f, Unassigned):
    if unassignedOkay:
      return f
@@ -41,36 +135,237 @@ def partialEval(f, env={}, unassignedOkay=False):
   else:
     raise TypeError("partialEval does not support type %s" % f.__class__.__name__)
 
-def create_facet(cond, left, right):
+'''
+Facet simplification.
+When enabled, create_facet applies these rewrites to the facets it builds:
+  nested      facets on the same label inside a branch, or on a label the
+              path environment decides, are replaced by their branch
+              consistent with it, down to SIMPLIFY_DEPTH levels;
+  unassigned  counts the facets dropped by the previous rule whose other
+              branch, unreachable on the path, was an Unassigned value;
+  merged      structurally equal branches are merged, by hash-consing both;
+  constant    constants that are equal without being the same value, such as
+              1 and 1.0, are merged.
+The branches are only searched for nested facets when their cached label
+masks meet the decided labels, so the common case costs a bit test.
+simplifyStats counts the facet nodes removed by each rule.
+'''
+simplifyFacets = True
+SIMPLIFY_DEPTH = 4
+simplifyStats = {'nested': 0, 'unassigned': 0, 'merged': 0, 'constant': 0}
+
+def setSimplifyFacets(enabled):
+  global simplifyFacets
+  simplifyFacets = enabled
+
+def getSimplifyStats():
+  return dict(simplifyStats)
+
+def resetSimplifyStats():
+  for rule in simplifyStats:
+    simplifyStats[rule] = 0
+
+# Build the facet on cond, for use on the path described by env.
+def create_facet(cond, left, right, env=emptyEnv):
+  if orderedFacets:
+    return orderedIte(cond, left, right, {})
+  if not simplifyFacets:
+    return reduce_facet(cond, left, right)
+  bit = 1 << cond.id
+  decided = env.decided | bit
+  values = env.values & ~bit
+  left = _restrict(left, decided, values | bit, SIMPLIFY_DEPTH)
+  right = _restrict(right, decided, values, SIMPLIFY_DEPTH)
+  left = hashcons(left)
+  right = hashcons(right)
+  if left is right:
+    simplifyStats['merged'] += 1
+    return left
+  r = reduce_facet(cond, left, right)
+  if r is left:
+    simplifyStats['constant'] += 1
+  return r
+
+# Replace the facets in f on decided labels by their branch for the value.
+def _restrict(f, decided, values, depth):
+  if depth == 0 or not isinstance(f, Facet):
+    return f
+  mask = f.labelMask()
+  if mask is not None and not mask & decided:
+    return f
+  bit = 1 << f.cond.id
+  if decided & bit:
+    simplifyStats['nested'] += 1
+    if isinstance(f.els if values & bit else f.thn, Unassigned):
+      simplifyStats['unassigned'] += 1
+    return _restrict(f.thn if values & bit else f.els, decided, values,
+      depth - 1)
+  thn = _restrict(f.thn, decided, values, depth - 1)
+  els = _restrict(f.els, decided, values, depth - 1)
+  if thn is f.thn and els is f.els:
+    return f
+  return reduce_facet(f.cond, thn, els)
+
+def reduce_facet(cond, left, right):
+  if left is right:
+    return left
   if isinstance(left, Constant) and isinstance(right, Constant) and left.v == right.v:
     return left
   if isinstance(left, FObject) and isinstance(right, FObject) and left.v is right.v:
     return left
-  return Facet(cond, left, right)
+  return mkFacet(cond, left, right)
 
 def facetApply(f, opr):
-  if isinstance(f, Facet):
-    return create_facet(f.cond, facetApply(f.thn, opr), facetApply(f.els, opr))
-  elif isinstance(f, Constant):
-    return Constant(opr(f.v))
-  elif isinstance(f, FObject):
-    return FObject(opr(f.v))
+  if orderedFacets:
+    return orderedApply(f, opr, {})
+  todo = [(_EVAL, f)]
+  results = []
+  while todo:
+    op, f = todo.pop()
+    if op == _FACET:
+      els = results.pop()
+      results.append(create_facet(f.cond, results.pop(), els))
+    elif isinstance(f, Facet):
+      todo.append((_FACET, f))
+      todo.append((_EVAL, f.els))
+      todo.append((_EVAL, f.thn))
+    elif isinstance(f, Constant):
+      results.append(mkConstant(opr(f.v)))
+    elif isinstance(f, FObject):
+      results.append(hashcons(FObject(opr(f.v))))
+    else:
+      results.append(None)
+  return results.pop()
 
 '''
-This function should combine two 
+This function should combine two
 
 NOTE(JY): We should just be able to use the universal Facet constructor
 instead of the weird stuff we were doing before... You may need to change
 things to get it to work though!
+
+The environment records the labels decided on the way down, so that facets of
+f1 on a label already split on in f0 take the branch that is consistent with
+it instead of producing contradictory paths.
+'''
+def facetJoin(f0, f1, opr, env=emptyEnv):
+  if orderedFacets:
+    return orderedJoin(f0, f1, opr, {})
+  decided = env.decided
+  values = env.values
+  todo = [(_EVAL, None, f0, f1)]
+  results = []
+  while todo:
+    op, cond, f0, f1 = todo.pop()
+    if op == _EVAL:
+      if isinstance(f0, Facet):
+        cond = f0.cond
+        thn0, els0, thn1, els1 = f0.thn, f0.els, f1, f1
+      elif isinstance(f1, Facet):
+        cond = f1.cond
+        thn0, els0, thn1, els1 = f0, f0, f1.thn, f1.els
+      else:
+        results.append(mkConstant(opr(f0.v, f1.v)))
+        continue
+      bit = 1 << cond.id
+      if decided & bit:
+        if values & bit:
+          todo.append((_EVAL, None, thn0, thn1))
+        else:
+          todo.append((_EVAL, None, els0, els1))
+      else:
+        decided |= bit
+        values |= bit
+        todo.append((_FACET, cond, None, None))
+        todo.append((_ELSE, cond, els0, els1))
+        todo.append((_EVAL, None, thn0, thn1))
+    elif op == _ELSE:
+      values &= ~(1 << cond.id)
+      todo.append((_EVAL, None, f0, f1))
+    else:
+      decided &= ~(1 << cond.id)
+      els = results.pop()
+      results.append(create_facet(cond, results.pop(), els))
+  return results.pop()
+
+# Two values are equivalent if they agree under every label assignment.
+# Ordered facets make this a pointer comparison.
+def facetEquals(f0, f1):
+  if not orderedFacets:
+    raise ValueError("facetEquals requires ordered facets")
+  return partialEval(fexpr_cast(f0), emptyEnv, True) is \
+    partialEval(fexpr_cast(f1), emptyEnv, True)
+
 '''
-def facetJoin(f0, f1, opr):
-  if isinstance(f0, Facet):
-    thn = facetJoin(f0.thn, f1, opr)
-    els = facetJoin(f0.els, f1, opr)
-    return create_facet(f0.cond, thn, els)
-  elif isinstance(f1, Facet):
-    thn = facetJoin(f0, f1.thn, opr)
-    els = facetJoin(f0, f1.els, opr)
-    return create_facet(f1.cond, thn, els)
+Operations on ordered facet diagrams.
+Each operation takes a memo table that lives for one top-level call. The
+table is keyed on node ids; the nodes involved are kept alive by the
+operands, so the ids cannot be reused during the call.
+'''
+def _top(f):
+  return f.cond if isinstance(f, Facet) else None
+
+def _cofactor(f, label, value):
+  if isinstance(f, Facet) and f.cond.id == label.id:
+    return f.thn if value else f.els
+  return f
+
+# Pick the earliest label at the top of any of the given diagrams.
+def _firstLabel(*fs):
+  best = None
+  for f in fs:
+    label = _top(f)
+    if label is not None and (best is None or
+        labelOrder(label) < labelOrder(best)):
+      best = label
+  return best
+
+def orderedIte(cond, thn, els, memo):
+  key = (id(cond), id(thn), id(els))
+  if key in memo:
+    return memo[key]
+  label = _firstLabel(thn, els)
+  if label is None or labelOrder(cond) <= labelOrder(label):
+    if label is not None and label.id == cond.id:
+      thn = _cofactor(thn, cond, True)
+      els = _cofactor(els, cond, False)
+    r = reduce_facet(cond, thn, els)
+  else:
+    r = reduce_facet(label,
+      orderedIte(cond, _cofactor(thn, label, True),
+        _cofactor(els, label, True), memo),
+      orderedIte(cond, _cofactor(thn, label, False),
+        _cofactor(els, label, False), memo))
+  memo[key] = r
+  return r
+
+def orderedApply(f, opr, memo):
+  if id(f) in memo:
+    return memo[id(f)]
+  if isinstance(f, Facet):
+    r = reduce_facet(f.cond, orderedApply(f.thn, opr, memo),
+          orderedApply(f.els, opr, memo))
+  elif isinstance(f, Constant):
+    r = mkConstant(opr(f.v))
+  elif isinstance(f, FObject):
+    r = hashcons(FObject(opr(f.v)))
+  else:
+    r = f
+  memo[id(f)] = r
+  return r
+
+def orderedJoin(f0, f1, opr, memo):
+  key = (id(f0), id(f1))
+  if key in memo:
+    return memo[key]
+  label = _firstLabel(f0, f1)
+  if label is None:
+    r = mkConstant(opr(f0.v, f1.v))
   else:
-    return Constant(opr(f0.v, f1.v))
+    r = reduce_facet(label,
+      orderedJoin(_cofactor(f0, label, True), _cofactor(f1, label, True),
+        opr, memo),
+      orderedJoin(_cofactor(f0, label, False), _cofactor(f1, label, False),
+        opr, memo))
+  memo[key] = r
+  return r
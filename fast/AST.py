@@ -6,6 +6,7 @@ in types explicitly. We might be able to have a much cleaner implementation than
 the Scala one!
 '''
 from abc import ABCMeta, abstractmethod
+import collections
 import operator
 import z3
 import JeevesLib
@@ -15,35 +16,125 @@ import env.VarEnv
 import env.PolicyEnv
 import env.PathVars
 import env.WritePolicyEnv
+import env.EvalCache
+import env.SolverPool
+import thread
 import threading
-from collections import defaultdict
+import weakref
+import heapq
+import itertools
+import smt.Z3
+
+'''
+The state of one thread.
+'''
+class ThreadState(object):
+  def __init__(self):
+    self.name = threading.current_thread().name
+    self.varenv = env.VarEnv.VarEnv()
+    self.pathenv = env.PathVars.PathVars()
+    self.policyenv = env.PolicyEnv.PolicyEnv()
+    self.writeenv = env.WritePolicyEnv.WritePolicyEnv()
+    self.all_labels = weakref.WeakValueDictionary()
+    self.evalcache = env.EvalCache.EvalCache()
+    self.solverpool = env.SolverPool.SolverPool()
+    # The environments saved by the enclosing scopes.
+    self.scopes = []
+
+  def sizes(self):
+    return {'name': self.name, 'labels': len(self.all_labels),
+            'policies': len(self.policyenv.policies),
+            'conditions': len(self.pathenv.conditions),
+            'evalcache': len(self.evalcache.entries),
+            'solvers': len(self.solverpool.free), 'scopes': len(self.scopes)}
+
+'''
+Gives each thread its own ThreadState, made the first time the thread uses
+it. The attributes of a threading.local are dropped when their thread ends, so
+the state of a finished thread is released with nothing else to clean up; the
+registry of states is weak. Looking the state up is also cheaper than keying
+dictionaries by threading.current_thread().
+'''
+class LocalState(threading.local):
+  def __init__(self, threads):
+    self.state = ThreadState()
+    threads[thread.get_ident()] = self.state
 
 class JeevesState:
   def __init__(self):
-    pass
+    self._threads = weakref.WeakValueDictionary()
 
   def init(self):
-    self._varenv = defaultdict(env.VarEnv.VarEnv)
-    self._pathenv = defaultdict(env.PathVars.PathVars)
-    self._policyenv = defaultdict(env.PolicyEnv.PolicyEnv)
-    self._writeenv = defaultdict(env.WritePolicyEnv.WritePolicyEnv)
-    self._all_labels = defaultdict(dict)
+    self._threads = weakref.WeakValueDictionary()
+    self._local = LocalState(self._threads)
+
+  # The state of the current thread, for code that uses several of its
+  # environments in a row.
+  @property
+  def state(self):
+    return self._local.state
+
+  # Drop the solvers pooled by every thread, so that they and their Z3
+  # contexts are freed before the interpreter shuts down.
+  def releaseSolvers(self):
+    for state in self._threads.values():
+      state.solverpool.clear()
+
+  # The sizes of the states of the threads that still have one, by thread id.
+  def threadSizes(self):
+    return {ident: state.sizes() for ident, state in self._threads.items()}
+
+  # Give the current thread fresh environments on top of its current ones,
+  # which are saved until popScope (see JeevesLib.scope).
+  def pushScope(self):
+    state = self._local.state
+    saved = (state.policyenv, state.pathenv, state.writeenv, state.all_labels)
+    state.scopes.append(saved)
+    state.policyenv = saved[0].child()
+    state.pathenv = saved[1].copy()
+    state.writeenv = saved[2].child()
+    state.all_labels = weakref.WeakValueDictionary()
+
+  def popScope(self):
+    state = self._local.state
+    (state.policyenv, state.pathenv, state.writeenv,
+     state.all_labels) = state.scopes.pop()
+
+  # The label with the given name in the current scope or the ones around
+  # it, or None.
+  def findLabel(self, name):
+    label = self.all_labels.get(name)
+    if label is None:
+      for scope in reversed(self.scopes):
+        label = scope[3].get(name)
+        if label is not None:
+          break
+    return label
 
   @property
   def varenv(self):
-    return self._varenv[threading.current_thread()]
+    return self._local.state.varenv
   @property
   def pathenv(self):
-    return self._pathenv[threading.current_thread()]
+    return self._local.state.pathenv
   @property
   def policyenv(self):
-    return self._policyenv[threading.current_thread()]
+    return self._local.state.policyenv
   @property
   def writeenv(self):
-    return self._writeenv[threading.current_thread()]
+    return self._local.state.writeenv
+  @property
+  def evalcache(self):
+    return self._local.state.evalcache
+  @property
+  def solverpool(self):
+    return self._local.state.solverpool
   @property
   def all_labels(self):
-    return self._all_labels[threading.current_thread()]
+    return self._local.state.all_labels
+  @property
+  def scopes(self):
+    return self._local.state.scopes
 
 jeevesState = JeevesState()
 
@@ -52,11 +143,62 @@ Abstract class for sensitive expressions.
 '''
 class FExpr:
   __metaclass__ = ABCMeta
-  
+
+  # Returns the set of labels the expression depends on.
   @abstractmethod
-  def vars(self):
+  def computeVars(self):
     return NotImplemented
 
+  # The free labels are computed once per node and kept as a frozenset.
+  # Nodes that wrap mutable containers are recomputed on every call.
+  def vars(self):
+    vs = self.__dict__.get('_vars')
+    if vs is None:
+      vs = frozenset(self.computeVars())
+      if not self.isVolatile():
+        self.__dict__['_vars'] = vs
+    return vs
+
+  def isVolatile(self):
+    volatile = self.__dict__.get('_volatile')
+    if volatile is None:
+      volatile = any(c.isVolatile() for c in self.getChildren())
+      self.__dict__['_volatile'] = volatile
+    return volatile
+
+  # The free labels as a bitset over label ids, or None for volatile nodes.
+  # Computed bottom-up with an explicit stack, so deep trees are fine.
+  def labelMask(self):
+    mask = self.__dict__.get('_mask')
+    if mask is None:
+      todo = [(self, False)]
+      while todo:
+        f, expanded = todo.pop()
+        if '_mask' in f.__dict__:
+          continue
+        children = f.getChildren()
+        if isinstance(f, Var):
+          mask = 1 << f.id
+        elif isinstance(f, FObject):
+          mask = -1 if f.isVolatile() else \
+            reduce(operator.or_, (1 << v.id for v in f.vars()), 0)
+        elif children and not expanded:
+          todo.append((f, True))
+          todo.extend((c, False) for c in children if isinstance(c, FExpr))
+          continue
+        else:
+          masks = [c.__dict__['_mask'] for c in children if isinstance(c, FExpr)]
+          mask = -1 if -1 in masks else reduce(operator.or_, masks, 0)
+        f.__dict__['_mask'] = mask
+      mask = self.__dict__['_mask']
+    return None if mask == -1 else mask
+
+  def dependsOn(self, label):
+    return label in self.vars()
+
+  def isLabelFree(self):
+    return not self.vars()
+
   # TODO: Need to figure out a way to thread the environment through eval so
   # we don't have to pass the argument explicitly. We also want to make sure
   # that we're using the correct environment though... Do we have to use some
@@ -67,6 +209,15 @@ class FExpr:
   def eval(self, env):
     return NotImplemented
 
+  # Count an evaluation and report whether the node has been evaluated often
+  # enough that it should run compiled (see compileExpr).
+  def isHot(self):
+    if '_compiled' in self.__dict__:
+      return True
+    n = self.__dict__.get('_evals', 0) + 1
+    self.__dict__['_evals'] = n
+    return n > COMPILE_THRESHOLD
+
   @abstractmethod
   def z3Node(self):
     return NotImplemented
@@ -86,6 +237,26 @@ class FExpr:
       "\n".join(child.prettyPrint(indent + "  ")
                 for child in self.getChildren()))
 
+  # Hash-consing support. Interned nodes are shared between expressions, so
+  # they must never be mutated. Since __eq__ builds an Eq node, structural
+  # equality goes through structKey() (or `is`, once both sides are interned).
+  _interned = False
+
+  # The key identifies the node kind and the identity of its children, so it
+  # is only structural once the children have been interned.
+  def structKey(self):
+    key = self.__dict__.get('_key')
+    if key is None:
+      key = (self.__class__,) + tuple(id(c) for c in self.getChildren())
+    return key
+
+  # Return a node of the same kind with the given children.
+  def rebuild(self, children):
+    return self.__class__(*children)
+
+  def structEq(self, other):
+    return hashcons(self) is hashcons(fexpr_cast(other))
+
   '''
   Sensitive Boolean expressions.
   NOTE(JY): I'm making the change Formula-> BoolExpr so that everything matches
@@ -167,24 +338,132 @@ class FExpr:
 class CannotEvalException(Exception):
   pass
 
+noVars = frozenset()
+
+'''
+Label ids.
+Every label name gets a small integer id, so that sets of labels and label
+assignments can be represented as bitsets (see env.PathVars.BitEnv). Vars with
+the same name denote the same label and share the id.
+
+The live Vars of each id are counted through weak references. Once they are all
+collected, recycle makes the id available to new names, smallest first, so
+that bitsets stay as short as the number of live labels. BitEnvs hold the
+Vars they assign, so the ids they use are not recycled.
+
+The table is shared by all threads, and locked; the lock is reentrant because
+track gets the id under it. Collected Vars are only queued by their weak
+reference callbacks, which take no lock: they can run while the lock is held,
+and while the interpreter shuts down. The queue is drained under the lock
+before the counts are used.
+'''
+class LabelIds:
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.ids = {}
+    self.names = []
+    self.live = []
+    # The weak references that count the live Vars, the ones of collected
+    # Vars not counted yet, the ids whose Vars have all been collected, and
+    # the ids free for reuse.
+    self.refs = {}
+    self.untracked = collections.deque()
+    self.dead = []
+    self.free = []
+
+  def get(self, name):
+    try:
+      return self.ids[name]
+    except KeyError:
+      with self.lock:
+        if name in self.ids:
+          return self.ids[name]
+        if self.free:
+          i = heapq.heappop(self.free)
+          self.names[i] = name
+        else:
+          self.names.append(name)
+          self.live.append(0)
+          i = len(self.names) - 1
+        self.ids[name] = i
+        return i
+
+  # Returns the id of an existing label name, or None.
+  def find(self, name):
+    return self.ids.get(name)
+
+  def name(self, i):
+    return self.names[i]
+
+  # Whether a Var with the name is still alive.
+  def isLive(self, name):
+    if self.untracked:
+      with self.lock:
+        self.drain()
+    i = self.ids.get(name)
+    return i is not None and self.live[i] > 0
+
+  # Count var as live until it is collected, and return the id of its name.
+  def track(self, var):
+    with self.lock:
+      self.drain()
+      i = self.get(var.name)
+      self.live[i] += 1
+      r = weakref.ref(var, self.untracked.append)
+      self.refs[id(r)] = (r, i)
+      return i
+
+  # Count the Vars collected since the last call. Called with the lock held.
+  def drain(self):
+    while self.untracked:
+      _, i = self.refs.pop(id(self.untracked.popleft()))
+      self.live[i] -= 1
+      if self.live[i] == 0:
+        self.dead.append(i)
+
+  # Free the ids of the names with no live Var. Returns how many were freed.
+  def recycle(self):
+    with self.lock:
+      self.drain()
+      freed = 0
+      for i in self.dead:
+        if self.live[i] == 0 and self.names[i] is not None:
+          del self.ids[self.names[i]]
+          self.names[i] = None
+          heapq.heappush(self.free, i)
+          freed += 1
+      self.dead = []
+      return freed
+
+  # The number of names with an id.
+  def __len__(self):
+    return len(self.ids)
+
+labelIds = LabelIds()
+
 def get_var_by_name(var_name):
-  v = Var()
-  v.name = var_name
-  return v
+  return Var(var_name, uniquify=False)
 
 class Var(FExpr):
-  counter = 0
+  # Taking the next number of an itertools.count is atomic, so labels made in
+  # different threads get different names.
+  counter = itertools.count()
+  # Every Var is a distinct label, so it is its own canonical node.
+  _interned = True
 
   def __init__(self, name=None, uniquify=True):
+    n = next(Var.counter)
+    # Orders labels by when they were made (see PolicyEnv.SolverState.reopen).
+    self.serial = n
     if name:
       if uniquify:
-        self.name = "v%d_%s" % (Var.counter, name)
+        self.name = "v%d_%s" % (n, name)
       else:
         self.name = name
     else:
-      self.name = "v%d" % Var.counter
+      self.name = "v%d" % n
+    self.id = labelIds.track(self)
     self.type = bool
-    Var.counter += 1
 
   def eval(self, env):
     try:
@@ -198,11 +477,11 @@ class Var(FExpr):
   def __str__(self):
     return self.name
 
-  def vars(self):
-    return {self}
+  def computeVars(self):
+    return (self,)
 
   def z3Node(self):
-    return z3.Bool(self.name)
+    return z3.Bool(self.name, smt.Z3.context())
 
   def getChildren(self):
     return []
@@ -210,11 +489,14 @@ class Var(FExpr):
   def prettyPrint(self, indent=""):
     return indent + self.name
 
+  def structKey(self):
+    return (Var, id(self))
+
 # helper methods for faceted __setattr__
 def get_objs_in_faceted_obj(f, d, env):
   if isinstance(f, Facet):
-    if f.cond.name in env:
-      if env[f.cond.name]:
+    if env.has(f.cond):
+      if env.get(f.cond):
         get_objs_in_faceted_obj(f.thn, d, env)
       else:
         get_objs_in_faceted_obj(f.els, d, env)
@@ -229,8 +511,8 @@ def get_objs_in_faceted_obj(f, d, env):
 
 def replace_obj_attributes(f, obj, oldvalue, newvalue, env):
   if isinstance(f, Facet):
-    if f.cond.name in env:
-      if env[f.cond.name]:
+    if env.has(f.cond):
+      if env.get(f.cond):
         return replace_obj_attributes(f.thn, obj, oldvalue, newvalue, env)
       else:
         return replace_obj_attributes(f.els, obj, oldvalue, newvalue, env)
@@ -278,10 +560,12 @@ class Facet(FExpr):
     self.__dict__['type'] = self.thn.type or self.els.type
 
   def eval(self, env):
+    if self.isHot():
+      return compileExpr(self)(env)
     return self.thn.eval(env) if self.cond.eval(env) else self.els.eval(env)
 
-  def vars(self):
-    return self.cond.vars().union(self.thn.vars()).union(self.els.vars())
+  def computeVars(self):
+    return self.cond.vars() | self.thn.vars() | self.els.vars()
 
   def z3Node(self):
     return z3.If(self.cond.z3Node(), self.thn.z3Node(), self.els.z3Node())
@@ -311,9 +595,10 @@ class Facet(FExpr):
 
   # called whenever an attribute that does not exist is accessed
   def __getattr__(self, attribute):
-    if JeevesLib.jeevesState.pathenv.hasPosVar(self.cond):
+    pathenv = jeevesState.pathenv
+    if pathenv.hasPosVar(self.cond):
       return getattr(self.thn, attribute)
-    elif JeevesLib.jeevesState.pathenv.hasNegVar(self.cond):
+    elif pathenv.hasNegVar(self.cond):
       return getattr(self.els, attribute)
     return Facet(self.cond,
       getattr(self.thn, attribute),
@@ -323,7 +608,7 @@ class Facet(FExpr):
     if attribute in self.__dict__:
       self.__dict__[attribute] = value
     else:
-      env = jeevesState.pathenv.getEnv()
+      env = jeevesState.pathenv.getBitEnv()
       value = fexpr_cast(value)
       objs = {}
       get_objs_in_faceted_obj(self, objs, env)
@@ -336,14 +621,15 @@ class Facet(FExpr):
         setattr(obj, attribute, t)
 
   def __getitem__(self, attribute):
-    if JeevesLib.jeevesState.pathenv.hasPosVar(self.cond):
+    pathenv = jeevesState.pathenv
+    if pathenv.hasPosVar(self.cond):
       return self.thn[attribute]
-    elif JeevesLib.jeevesState.pathenv.hasNegVar(self.cond):
+    elif pathenv.hasNegVar(self.cond):
       return self.els[attribute]
     return Facet(self.cond, self.thn[attribute], self.els[attribute])
 
   def __setitem__(self, attribute, value):
-    env = jeevesState.pathenv.getEnv()
+    env = jeevesState.pathenv.getBitEnv()
     value = fexpr_cast(value)
     objs = {}
     get_objs_in_faceted_obj(self, objs, env)
@@ -411,8 +697,8 @@ class Constant(FExpr):
   def eval(self, env):
     return self.v
 
-  def vars(self):
-    return set()
+  def computeVars(self):
+    return noVars
 
   def z3Node(self):
     return self.v
@@ -426,6 +712,9 @@ class Constant(FExpr):
   def prettyPrint(self, indent=""):
     return indent + "const:" + repr(self.v)
 
+  def structKey(self):
+    return constantKey(self.v)
+
   def __call__(self, *args, **kw):
     return self.v(*args, **kw)
 
@@ -438,8 +727,8 @@ class BinaryExpr(FExpr):
     self.right = right
     self.type = self.ret_type
 
-  def vars(self):
-    return self.left.vars().union(self.right.vars())
+  def computeVars(self):
+    return self.left.vars() | self.right.vars()
 
   def getChildren(self):
     return [self.left, self.right]
@@ -449,7 +738,7 @@ class UnaryExpr(FExpr):
     self.sub = sub
     self.type = self.ret_type
 
-  def vars(self):
+  def computeVars(self):
     return self.sub.vars()
 
   def getChildren(self):
@@ -679,6 +968,8 @@ class GtE(BinaryExpr):
       , self.right.remapLabels(policy, writer))
 
 class Unassigned(FExpr):
+  _interned = True
+
   def __init__(self, thing_not_found):
     self.type = None
     self.thing_not_found = thing_not_found
@@ -690,12 +981,14 @@ class Unassigned(FExpr):
     return []
   def remapLabels(self, policy):
     return self
-  def vars(self):
-    return set()
+  def computeVars(self):
+    return noVars
   def remapLabels(self, policy, writer):
     return self
   def getException(self):
     return Exception("wow such error: %s does not exist." % (self.thing_not_found,))
+  def structKey(self):
+    return (Unassigned, id(self))
   def __call__(self, *args, **kwargs):
     raise self.getException()
   def __getattr__(self, attr):
@@ -732,13 +1025,17 @@ class FObject(FExpr):
     else:
       return self.v
 
-  def vars(self):
+  def computeVars(self):
     if isinstance(self.v, JeevesLib.JList):
       return self.v.l.vars()
     elif isinstance(self.v, JeevesLib.JList2):
       return self.v.vars()
     else:
-      return set()
+      return noVars
+
+  # Lists can be appended to, which changes their labels.
+  def isVolatile(self):
+    return isinstance(self.v, (JeevesLib.JList, JeevesLib.JList2))
 
   def z3Node(self):
     return id(self)
@@ -826,6 +1123,244 @@ class FObject(FExpr):
   def prettyPrint(self, indent=""):
     return 'FObject:%s' % str(self.v)
 
+  # FObjects with the same underlying object are interchangeable.
+  def structKey(self):
+    return (FObject, id(self.v))
+
+'''
+Hash-consing.
+The unique table maps structural keys to live nodes, so that building a node
+that already exists returns the existing one. Entries are weak: a node leaves
+the table as soon as nothing else refers to it. Because a node holds its
+children, the ids in a live node's key cannot be reused. Interning is locked,
+so that threads agree on the canonical nodes.
+'''
+class UniqueTable:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.table = weakref.WeakValueDictionary()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self.table)
+
+  def lookup(self, key):
+    node = self.table.get(key)
+    if node is not None:
+      self.hits += 1
+    return node
+
+  # Assumes that the children of node are already interned.
+  def intern(self, node):
+    key = node.structKey()
+    existing = self.lookup(key)
+    if existing is not None:
+      return existing
+    self.misses += 1
+    node.__dict__['_key'] = key
+    node.__dict__['_interned'] = True
+    with self.lock:
+      return self.table.setdefault(key, node)
+
+uniqueTable = UniqueTable()
+
+# Return the canonical node structurally equal to f. Built bottom-up with an
+# explicit stack, so deep trees are fine.
+def hashcons(f):
+  if f._interned:
+    return f
+  # The canonical nodes of the subtrees done so far, by id.
+  canonical = {}
+  todo = [(f, False)]
+  while todo:
+    g, expanded = todo.pop()
+    if id(g) in canonical:
+      continue
+    children = g.getChildren()
+    if not expanded:
+      todo.append((g, True))
+      todo.extend((c, False) for c in children if not c._interned)
+      continue
+    interned = [c if c._interned else canonical[id(c)] for c in children]
+    node = g
+    if any(c is not i for c, i in zip(children, interned)):
+      node = g.rebuild(interned)
+    canonical[id(g)] = uniqueTable.intern(node)
+  return canonical[id(f)]
+
+# Build an interned node without allocating it if it already exists.
+def mkNode(cls, *children):
+  children = [hashcons(c) for c in children]
+  key = (cls,) + tuple(id(c) for c in children)
+  node = uniqueTable.lookup(key)
+  if node is None:
+    node = uniqueTable.intern(cls(*children))
+  return node
+
+def mkFacet(cond, thn, els):
+  return mkNode(Facet, cond, fexpr_cast(thn), fexpr_cast(els))
+
+'''
+Constants are merged by value only when equal values of their type are the
+same value: the type is part of the key so that 1, 1.0 and True stay distinct,
+and floats are keyed by their repr so that 0.0 and -0.0 do too. Other values,
+such as Decimals, datetimes and tuples, can be equal to a different value, so
+they are keyed by identity. The node holds the value, so its id is not reused
+while the node is in the table.
+'''
+_valueKeyTypes = frozenset([bool, int, long, str, unicode, type(None)])
+
+def constantKey(v):
+  t = type(v)
+  if t in _valueKeyTypes:
+    return (Constant, t, v)
+  if t is float:
+    return (Constant, t, repr(v))
+  return (Constant, t, id(v))
+
+def mkConstant(v):
+  key = constantKey(v)
+  node = uniqueTable.lookup(key)
+  if node is None:
+    node = uniqueTable.intern(Constant(v))
+  return node
+
+'''
+Compiled evaluation.
+compileExpr(f) generates a flat Python function from a label assignment to the
+value of f, the same as f.eval. It is generated once and cached on the node.
+Facets and the short-circuiting boolean operators become if statements, so
+only the branches eval would visit are evaluated. Subtrees that are shared or
+nested more than MAX_NESTING deep get a function of their own, which keeps the
+generated code linear in the size of the expression.
+'''
+COMPILE_THRESHOLD = 8
+MAX_NESTING = 16
+
+_infixOps = { Add: '+', Sub: '-', Mult: '*', Div: '/', Mod: '%'
+            , BitAnd: '&', BitOr: '|', LShift: '<<', RShift: '>>'
+            , Eq: '==', Lt: '<', LtE: '<=', Gt: '>', GtE: '>=' }
+
+def compileExpr(f):
+  compiled = f.__dict__.get('_compiled')
+  if compiled is None:
+    compiled = _Compiler(f, _countUses(f)).compile()
+  return compiled
+
+# Evaluate f, switching to the compiled version once f is hot.
+def evalExpr(f, env):
+  if isinstance(f, (BinaryExpr, UnaryExpr)) and f.isHot():
+    return compileExpr(f)(env)
+  return f.eval(env)
+
+def _countUses(root):
+  uses = {}
+  stack = [root]
+  while stack:
+    f = stack.pop()
+    n = uses.get(id(f), 0)
+    uses[id(f)] = n + 1
+    if n == 0:
+      stack.extend(f.getChildren())
+  return uses
+
+# Defer compiling a subtree until it is first evaluated.
+def _lazyCompiled(f, uses):
+  def run(env):
+    compiled = f.__dict__.get('_compiled')
+    if compiled is None:
+      compiled = _Compiler(f, uses).compile()
+    return compiled(env)
+  return run
+
+class _Compiler:
+  def __init__(self, root, uses):
+    self.root = root
+    self.uses = uses
+    self.names = {}
+    self.lines = []
+    self.indent = 1
+    self.count = 0
+
+  def compile(self):
+    result = self.emit(self.root, 0)
+    src = "def _compiled(env):\n%s\n  return %s\n" % (
+      "\n".join("  " * indent + line for indent, line in self.lines), result)
+    exec src in self.names
+    compiled = self.names['_compiled']
+    self.root.__dict__['_compiled'] = compiled
+    return compiled
+
+  def fresh(self, prefix):
+    self.count += 1
+    return "%s%d" % (prefix, self.count)
+
+  def bind(self, prefix, value):
+    name = self.fresh(prefix)
+    self.names[name] = value
+    return name
+
+  def line(self, text):
+    self.lines.append((self.indent, text))
+
+  # Emit the statements for the branch of an if and assign its value to t.
+  def branch(self, f, t, depth):
+    self.indent += 1
+    self.line("%s = %s" % (t, self.emit(f, depth)))
+    self.indent -= 1
+
+  # Emit the statements computing f and return an expression for its value.
+  def emit(self, f, depth):
+    if isinstance(f, Var):
+      return "env[%s]" % self.bind("v", f)
+    elif isinstance(f, Constant):
+      return self.bind("k", f.v)
+    elif not isinstance(f, (Facet, BinaryExpr, UnaryExpr)):
+      return "%s.eval(env)" % self.bind("o", f)
+    elif f is not self.root and (self.uses.get(id(f), 1) > 1 or
+        depth > MAX_NESTING):
+      return "%s(env)" % self.bind("c", _lazyCompiled(f, self.uses))
+    elif isinstance(f, Facet):
+      t = self.fresh("t")
+      self.line("if %s:" % self.emit(f.cond, depth + 1))
+      self.branch(f.thn, t, depth + 1)
+      self.line("else:")
+      self.branch(f.els, t, depth + 1)
+      return t
+    elif isinstance(f, Not):
+      return "(not %s)" % self.emit(f.sub, depth + 1)
+    elif isinstance(f, (And, Or, Implies)):
+      left = self.emit(f.left, depth + 1)
+      if isinstance(f, Implies):
+        left = "(not %s)" % left
+      op = "and" if isinstance(f, And) else "or"
+      n = len(self.lines)
+      self.indent += 1
+      right = self.emit(f.right, depth + 1)
+      self.indent -= 1
+      if len(self.lines) == n:
+        return "(%s %s %s)" % (left, op, right)
+      # The right operand needs statements: only run them when eval would.
+      t = self.fresh("t")
+      self.lines[n:n] = [
+          (self.indent, "%s = %s" % (t, left))
+        , (self.indent, ("if %s:" if op == "and" else "if not %s:") % t)]
+      self.lines.append((self.indent + 1, "%s = %s" % (t, right)))
+      return t
+    elif type(f) in _infixOps:
+      left = self.emit(f.left, depth + 1)
+      n = len(self.lines)
+      right = self.emit(f.right, depth + 1)
+      if len(self.lines) > n:
+        # Keep eval's order: the left operand is computed before the right.
+        t = self.fresh("t")
+        self.lines.insert(n, (self.indent, "%s = %s" % (t, left)))
+        left = t
+      return "(%s %s %s)" % (left, _infixOps[type(f)], right)
+    else:
+      return "%s.eval(env)" % self.bind("o", f)
+
 """
   def __and__(l, r):
   def __rand__(r, l):
@@ -9,6 +9,7 @@ import django.db.models.fields.related
 import JeevesLib
 from JeevesLib import fexpr_cast
 from eval.Eval import partialEval
+from env.PathVars import emptyEnv
 from fast.AST import Facet, FObject, Unassigned, get_var_by_name, FExpr
 
 import string
@@ -16,20 +17,34 @@ import random
 import itertools
 
 class JeevesQuerySet(QuerySet):
+  # With a pinned viewer, rows the viewer does not see are dropped, and the
+  # labels decided for it are left out of the conditions. They are kept on
+  # the object instead, so that saving it only writes what the viewer sees,
+  # and they stay alive with it.
   @JeevesLib.supports_jeeves
-  def get_jiter(self):
+  def get_jiter(self, use_pinned=True):
     self._fetch_all()
+    policyenv = JeevesLib.jeevesState.policyenv
 
     def get_env(obj, fields, env):
       if hasattr(obj, "jeeves_vars"):
         vs = unserialize_vars(obj.jeeves_vars)
       else:
         vs = {}
+      pinned = {}
       for var_name, value in vs.iteritems():
+        label = acquire_label_by_name(self.model._meta.app_label, var_name)
+        known = policyenv.pinnedValue(label) if use_pinned else None
+        if known is not None:
+          if known != value:
+            return None
+          pinned[label] = value
+          continue
         if var_name in env and env[var_name] != value:
           return None
         env[var_name] = value
-        acquire_label_by_name(self.model._meta.app_label, var_name)
+      if pinned:
+        obj._jeeves_pinned = pinned
       for field, subs in (fields.iteritems() if fields else []):
         if field and get_env(getattr(obj, field), subs, env) is None:
           return None
@@ -43,7 +58,9 @@ class JeevesQuerySet(QuerySet):
     return results
 
   def get(self, use_base_env=False, **kwargs):
-    l = self.filter(**kwargs).get_jiter()
+    # The base environment is used for the objects policies read, which are
+    # kept after the viewer is unpinned.
+    l = self.filter(**kwargs).get_jiter(use_pinned=not use_base_env)
     if len(l) == 0:
       return None
     
@@ -61,7 +78,7 @@ class JeevesQuerySet(QuerySet):
         else:
           cur = Facet(acquire_label_by_name(self.model._meta.app_label, var_name), old, cur)
     try:
-      return partialEval(cur, {} if use_base_env else JeevesLib.jeevesState.pathenv.getEnv())
+      return partialEval(cur, emptyEnv if use_base_env else JeevesLib.jeevesState.pathenv.getBitEnv())
     except TypeError:
       raise Exception("wow such error: could not find a row for every condition")
 
@@ -79,15 +96,15 @@ class JeevesQuerySet(QuerySet):
   @JeevesLib.supports_jeeves
   def all(self):
     t = JeevesLib.JList2([])
-    env = JeevesLib.jeevesState.pathenv.getEnv()
+    env = JeevesLib.jeevesState.pathenv.getBitEnv()
     for val, cond in self.get_jiter():
       popcount = 0
       for vname, vval in cond.iteritems():
-        if vname not in env:
-          v = acquire_label_by_name(self.model._meta.app_label, vname)
+        v = acquire_label_by_name(self.model._meta.app_label, vname)
+        if not env.has(v):
           JeevesLib.jeevesState.pathenv.push(v, vval)
           popcount += 1
-        elif env[vname] != vval:
+        elif env.get(v) != vval:
           break
       else:
         t.append(val)
@@ -102,8 +119,8 @@ class JeevesQuerySet(QuerySet):
     for val, cond in self.get_jiter():
       popcount = 0
       for vname, vval in cond.iteritems():
-        if vname not in JeevesLib.jeevesState.pathenv.getEnv():
-          v = acquire_label_by_name(self.model._meta.app_label, vname)
+        v = acquire_label_by_name(self.model._meta.app_label, vname)
+        if not JeevesLib.jeevesState.pathenv.getBitEnv().has(v):
           JeevesLib.jeevesState.pathenv.push(v, vval)
           popcount += 1
       val.delete()
@@ -190,6 +207,24 @@ def fullEval(val, env):
   p = partialEval(val, env)
   return p.v
 
+# Run a method of a JeevesModel with the labels decided for the pinned viewer
+# when the object was read on the path, as they are for each facet of a
+# faceted object.
+def under_pinned_labels(method):
+  def wrapper(self, *args, **kw):
+    pathenv = JeevesLib.jeevesState.pathenv
+    pushed = 0
+    for label, value in getattr(self, '_jeeves_pinned', {}).iteritems():
+      if not pathenv.getBitEnv().has(label):
+        pathenv.push(label, value)
+        pushed += 1
+    try:
+      return method(self, *args, **kw)
+    finally:
+      for _ in xrange(pushed):
+        pathenv.pop()
+  return wrapper
+
 def acquire_label_by_name(app_label, label_name):
   if JeevesLib.doesLabelExist(label_name):
     return JeevesLib.getLabel(label_name)
@@ -201,7 +236,8 @@ def acquire_label_by_name(app_label, label_name):
     # already fetching
     obj = model.objects.get(use_base_env=True, jeeves_id=jeeves_id)
     restrictor = getattr(model, 'jeeves_restrict_' + field_name)
-    JeevesLib.restrict(label, lambda ctxt : restrictor(obj, ctxt), True)
+    JeevesLib.restrict(label, lambda ctxt : restrictor(obj, ctxt), True,
+      policy_key(restrictor, obj))
     return label
  
 def get_one_differing_var(e1, e2):
@@ -225,6 +261,23 @@ def label_for(*field_names):
         return f
     return decorator
 
+# Declares that a jeeves_restrict_ method reads only the row, which save and
+# delete invalidate, and what key(row) covers, so that the label of a row made
+# again in a later request can be decided from the label cache. The key must
+# be a hashable concrete value.
+def label_cache_key(key=lambda row: ()):
+    def decorator(f):
+        f._jeeves_cache_key = key
+        return f
+    return decorator
+
+def policy_key(restrictor, obj):
+  key = getattr(restrictor, '_jeeves_cache_key', None)
+  if key is None:
+    return None
+  key = key(obj)
+  return None if isinstance(key, FExpr) else key
+
 #from django.db.models.base import ModelBase
 #class JeevesModelBase(ModelBase):
 #  def __new__(cls, name, bases, attrs):
@@ -238,7 +291,7 @@ def label_for(*field_names):
 
 class JeevesModel(models.Model):
   def __init__(self, *args, **kw):
-    self.jeeves_base_env = JeevesLib.jeevesState.pathenv.getEnv()
+    self.jeeves_base_env = JeevesLib.jeevesState.pathenv.getBitEnv()
     super(JeevesModel, self).__init__(*args, **kw)
 
     self._jeeves_labels = {}
@@ -302,10 +355,19 @@ class JeevesModel(models.Model):
     else:
       label = JeevesLib.mkLabel(label_name, uniquify=False)
       restrictor = getattr(self, 'jeeves_restrict_' + field_name)
-      JeevesLib.restrict(label, lambda ctxt : restrictor(self, ctxt), True)
+      JeevesLib.restrict(label, lambda ctxt : restrictor(self, ctxt), True,
+        policy_key(restrictor, self))
       return label
 
+  # The policies of the row's labels may read what is saved or deleted, and
+  # a later row can have the same jeeves_id.
+  def invalidate_policies(self):
+    for label_name in self._jeeves_labels:
+      JeevesLib.invalidatePolicies('%s__%s__%s' %
+        (self.__class__.__name__, label_name, self.jeeves_id))
+
   @JeevesLib.supports_jeeves
+  @under_pinned_labels
   def save(self, *args, **kw):
     if not self.jeeves_id:
       self.jeeves_id = get_random_jeeves_id()
@@ -313,6 +375,8 @@ class JeevesModel(models.Model):
     if kw.get("update_field", None) is not None:
       raise NotImplementedError("Partial saves not supported.")
 
+    self.invalidate_policies()
+
     field_names = set()
     for field in self._meta.concrete_fields:
       if not field.primary_key and not hasattr(field, 'through'):
@@ -323,18 +387,20 @@ class JeevesModel(models.Model):
       for field_name in field_name_list:
         public_field_value = getattr(self, field_name)
         private_field_value = getattr(self, 'jeeves_get_private_' + field_name)(self)
+        # Both facets are stored, whatever a pinned viewer sees.
         faceted_field_value = partialEval(
-          JeevesLib.mkSensitive(label, public_field_value, private_field_value),
-          JeevesLib.jeevesState.pathenv.getEnv()
+          Facet(label, fexpr_cast(public_field_value), fexpr_cast(private_field_value)),
+          JeevesLib.jeevesState.pathenv.getBitEnv()
         )
         setattr(self, field_name, faceted_field_value)
 
     all_vars = []
     d = {}
     env = JeevesLib.jeevesState.pathenv.getEnv()
+    bitenv = JeevesLib.jeevesState.pathenv.getBitEnv()
     for field_name in field_names:
       value = getattr(self, field_name)
-      f = partialEval(fexpr_cast(value), env)
+      f = partialEval(fexpr_cast(value), bitenv)
       all_vars.extend(v.name for v in f.vars())
       d[field_name] = f
     all_vars = list(set(all_vars))
@@ -376,10 +442,13 @@ class JeevesModel(models.Model):
       super(JeevesModel, obj_to_save).save(*args, **kw)
 
   @JeevesLib.supports_jeeves
+  @under_pinned_labels
   def delete(self, *args, **kw):
     if self.jeeves_id is None:
       return
 
+    self.invalidate_policies()
+
     field_names = set()
     for field in self._meta.concrete_fields:
       if not field.primary_key and not hasattr(field, 'through'):
@@ -388,9 +457,10 @@ class JeevesModel(models.Model):
     all_vars = []
     d = {}
     env = JeevesLib.jeevesState.pathenv.getEnv()
+    bitenv = JeevesLib.jeevesState.pathenv.getBitEnv()
     for field_name in field_names:
       value = getattr(self, field_name)
-      f = partialEval(fexpr_cast(value), env)
+      f = partialEval(fexpr_cast(value), bitenv)
       all_vars.extend(v.name for v in f.vars())
       d[field_name] = f
 
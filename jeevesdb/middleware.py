@@ -0,0 +1,38 @@
+import threading
+
+import JeevesLib
+
+'''
+Serves each request in its own Jeeves scope (see JeevesLib.scope), so that
+the labels and policies it makes are dropped once it is done.
+
+The scope is closed by process_response, or by process_exception when the
+view raises. Neither is called when an error skips the response middleware,
+so a scope still open on the thread when the next request starts is closed
+first, with any scope left open inside it.
+'''
+class JeevesScopeMiddleware(object):
+  # The number of scopes around the one opened for the thread's request.
+  opened = threading.local()
+
+  def process_request(self, request):
+    self.closeScope()
+    self.opened.depth = len(JeevesLib.jeevesState.scopes)
+    JeevesLib.jeevesState.pushScope()
+
+  def process_exception(self, request, exception):
+    self.closeScope()
+    return None
+
+  # Also called after an exception, with the error response.
+  def process_response(self, request, response):
+    self.closeScope()
+    return response
+
+  def closeScope(self):
+    depth = getattr(self.opened, 'depth', None)
+    if depth is None:
+      return
+    del self.opened.depth
+    while len(JeevesLib.jeevesState.scopes) > depth:
+      JeevesLib.jeevesState.popScope()
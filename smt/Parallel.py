@@ -0,0 +1,108 @@
+'''
+Deciding independent groups of labels in worker processes.
+
+The labels to decide come in groups whose constraints share no labels (see
+env.PolicyEnv.LabelComponents), so that each group can be decided on its own. The groups are shipped to the
+workers as SMT-LIB 2 text, so that no closures or expression objects cross
+process boundaries. A worker parses each group into a solver of its own and
+decides its labels in order as SolverState does: a label is HIGH if that is
+still satisfiable. Deciding independent groups separately gives the same
+labels as deciding them all with one solver.
+'''
+import heapq
+import multiprocessing
+import threading
+import z3
+
+import smt.Z3
+from smt.SMT import UnsatisfiableException
+
+'''
+Pack groups into at most n jobs with about the same number of labels to
+decide, largest groups first.
+'''
+def pack(groups, n):
+  jobs = [(0, i, []) for i in xrange(n)]
+  for group in sorted(groups, key=lambda group: -len(group[1])):
+    size, i, job = heapq.heappop(jobs)
+    job.append(group)
+    heapq.heappush(jobs, (size + len(group[1]), i, job))
+  return [job for _, _, job in sorted(jobs, key=lambda j: j[1]) if job]
+
+# Written out directly: making a solver for each group costs more than
+# deciding it.
+def toSmt2(constraints):
+  decls = set()
+  asserts = []
+  for c in constraints:
+    for v in c.vars():
+      decls.add('(declare-const %s Bool)' % v.z3Node().sexpr())
+    asserts.append('(assert %s)' % c.z3Node().sexpr())
+  return '\n'.join(sorted(decls) + asserts)
+
+# Runs in a worker: decide the labels of each group of a job, checking first
+# that the constraints of each group are satisfiable if check is set.
+def decideJob(job):
+  check, groups = job
+  ctx = z3.Context()
+  solver = z3.Solver(ctx=ctx)
+  values = []
+  for smt2, names in groups:
+    solver.push()
+    solver.from_string(smt2)
+    if check and solver.check() != z3.sat:
+      raise UnsatisfiableException("Constraints not satisfiable")
+    values.append(decideInOrder(solver, names))
+    solver.pop()
+  return values
+
+def decideInOrder(solver, names):
+  values = []
+  for name in names:
+    var = z3.Bool(name, solver.ctx)
+    r = solver.check(var)
+    if r == z3.sat:
+      solver.add(var)
+      values.append(True)
+    elif r == z3.unsat:
+      solver.add(z3.Not(var))
+      values.append(False)
+    else:
+      raise ValueError("got neither sat nor unsat from solver")
+  return values
+
+'''
+Decide the labels of groups of (constraints, names) pairs, in the processes of
+pool, packed into at most jobs jobs. With check, the constraints of every group
+are checked first, and UnsatisfiableException is raised if those of one are not
+satisfiable. Returns a dictionary from label names to values.
+'''
+def decide(groups, pool, jobs, check=False):
+  batches = pack(groups, jobs)
+  shipped = [(check, [(toSmt2(cs), ns) for cs, ns in batch])
+             for batch in batches]
+  result = {}
+  for batch, values in zip(batches, pool.map(decideJob, shipped)):
+    for (_, ns), vs in zip(batch, values):
+      result.update(zip(ns, vs))
+  return result
+
+_pool = None
+_processes = 0
+_poolLock = threading.Lock()
+
+'''
+The pool of worker processes, made on first use. A different number of
+processes replaces it; by default it has one per CPU. Returns the pool and
+its number of processes.
+'''
+def processPool(processes=None):
+  global _pool, _processes
+  with _poolLock:
+    if _pool is None or (processes is not None and processes != _processes):
+      if _pool is not None:
+        _pool.close()
+        _pool.join()
+      _processes = processes or multiprocessing.cpu_count()
+      _pool = multiprocessing.Pool(_processes)
+    return _pool, _processes
@@ -2,11 +2,59 @@
 Defines the interface to the Z3 solver.
 '''
 # TODO: Define UnsatException and SolverException
+import gc
+import thread
+import threading
+import time
+import weakref
 import z3
 
+_local = threading.local()
+# The contexts made for threads, by thread id.
+contexts = weakref.WeakValueDictionary()
+
+'''
+The Z3 context of the current thread. Z3 contexts cannot be shared between
+threads, so each thread other than the main one makes its own, and the
+solvers and the label constants of a thread live in its context. The main
+thread uses Z3's default context, given as None.
+'''
+def context():
+  try:
+    return _local.ctx
+  except AttributeError:
+    if isinstance(threading.current_thread(), threading._MainThread):
+      ctx = None
+    else:
+      ctx = z3.Context()
+      contexts[thread.get_ident()] = ctx
+    _local.ctx = ctx
+    return ctx
+
+'''
+Wait for the contexts of the threads that have ended to be freed, which
+happens shortly after the threads end, or later if they are held in cycles.
+Contexts freed while the interpreter shuts down report errors.
+'''
+def awaitEndedContexts(timeout=1.0):
+  deadline = time.time() + timeout
+  while True:
+    gc.collect()
+    live = set(t.ident for t in threading.enumerate())
+    if all(ident in live for ident in contexts.keys()):
+      return True
+    if time.time() > deadline:
+      return False
+    time.sleep(0.001)
+
 class Z3:
   def __init__(self):
-    self.solver = z3.Solver()
+    self.ctx = context()
+    self.solver = z3.Solver(ctx=self.ctx)
+    # The number of satisfiability checks made.
+    self.checks = 0
+    # The number of open push frames.
+    self.scopes = 0
 
   # TODO: Is this the place to do this?
   #def __del__(self):
@@ -14,15 +62,17 @@ class Z3:
 
   # Defining variables.
   def getIntVar(self, name):
-    return z3.Int(name)
+    return z3.Int(name, self.ctx)
 
   def getBoolVar(self, name):
-    return z3.Bool(name)
+    return z3.Bool(name, self.ctx)
 
   def check(self):
+    self.checks += 1
     return self.solver.check()
 
   def isSatisfiable(self):
+    self.checks += 1
     r = self.solver.check()
     if r == z3.sat:
       return True
@@ -31,6 +81,21 @@ class Z3:
     else:
       raise ValueError("got neither sat nor unsat from solver")
 
+  # Make the given Boolean expressions true greedily in order, as asserting
+  # each one that is still satisfiable would, with a single optimization call:
+  # every expression outweighs all the ones after it together.
+  def maximizeInOrder(self, exprs):
+    opt = z3.Optimize(ctx=self.ctx)
+    opt.add(self.solver.assertions())
+    for i, e in enumerate(exprs):
+      opt.add_soft(e.z3Node(), 2 ** (len(exprs) - i))
+    self.checks += 1
+    if opt.check() != z3.sat:
+      raise ValueError("got no model from the optimizer")
+    model = opt.model()
+    return [z3.is_true(model.eval(e.z3Node(), model_completion=True))
+            for e in exprs]
+
   def evaluate(self, t):
     s = self.solver.model().eval(t.z3Node())
     assert z3.is_true(s) or z3.is_false(s)
@@ -43,10 +108,23 @@ class Z3:
     return self.solver.add(constraint.z3Node())
 
   def push(self):
+    self.scopes += 1
     self.solver.push()
 
   def pop(self):
+    self.scopes -= 1
     self.solver.pop()
 
+  # Pop every open frame, back to the base scope.
+  def popAll(self):
+    if self.scopes > 0:
+      self.solver.pop(self.scopes)
+      self.scopes = 0
+
+  # Remove every assertion and frame.
+  def clear(self):
+    self.solver.reset()
+    self.scopes = 0
+
   def reset(self):
     self.solver.reset_memory()
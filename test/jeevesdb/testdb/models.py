@@ -21,6 +21,7 @@ class AnimalWithPolicy(JeevesModel.JeevesModel):
     return ""
 
   @staticmethod
+  @JeevesModel.label_cache_key()
   def jeeves_restrict_sound(animal, ctxt):
     return ctxt == animal
 
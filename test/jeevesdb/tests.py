@@ -5,6 +5,7 @@ from django.test import TestCase
 import JeevesLib
 
 from jeevesdb import JeevesModel
+from jeevesdb.middleware import JeevesScopeMiddleware
 from testdb.models import Animal, Zoo, AnimalWithPolicy, AnimalWithPolicy2
 
 def parse_vars_row(vs):
@@ -448,3 +449,124 @@ class TestJeevesModel(TestCase):
       ({'name':'testpolicy2', 'sound':'meow'}, {name:True}),
       ({'name':'testpolicy2', 'sound':''}, {name:False}),
      ]))
+
+  def testPolicyMemoInvalidated(self):
+    JeevesLib.setViewerKey(lambda ctxt: ctxt.jeeves_id)
+    JeevesLib.setPolicyMemo()
+    awp = AnimalWithPolicy.objects.create(name='testpolicy3', sound='meow')
+    name = 'AnimalWithPolicy__sound__' + awp.jeeves_id
+    label = JeevesLib.getLabel(name)
+    JeevesLib.concretize(awp, label)
+    self.assertTrue(name in JeevesLib.jeevesState.policyenv.policyMemo)
+
+    awp.save()
+    self.assertFalse(name in JeevesLib.jeevesState.policyenv.policyMemo)
+
+    JeevesLib.concretize(awp, label)
+    AnimalWithPolicy.objects.filter(jeeves_id=awp.jeeves_id).delete()
+    self.assertFalse(name in JeevesLib.jeevesState.policyenv.policyMemo)
+
+  def testPinnedViewer(self):
+    awp = AnimalWithPolicy.objects.create(name='testpin1', sound='meow')
+    other = AnimalWithPolicy.objects.create(name='testpin2', sound='purr')
+    JeevesLib.pin_viewer(awp)
+
+    # Only the rows the viewer sees are read.
+    a = AnimalWithPolicy.objects.get(name='testpin1')
+    b = AnimalWithPolicy.objects.get(name='testpin2')
+    self.assertEqual(a.sound, 'meow')
+    self.assertEqual(b.sound, '')
+    self.assertRaises(JeevesLib.PinnedViewerException,
+      JeevesLib.concretize, other, a.sound)
+
+    # Saving what was read only writes the rows the viewer sees.
+    b.name = 'testpin3'
+    b.save()
+    name = 'AnimalWithPolicy__sound__' + other.jeeves_id
+    rows = AnimalWithPolicy._objects_ordinary.filter(jeeves_id=other.jeeves_id)
+    self.assertTrue(areRowsEqual(rows, [
+      ({'name':'testpin2', 'sound':'purr'}, {name:True}),
+      ({'name':'testpin3', 'sound':''}, {name:False}),
+     ]))
+
+    # The labels stay with the object after the viewer is unpinned.
+    c = AnimalWithPolicy.objects.get(name='testpin3')
+    jeeves_id = other.jeeves_id
+    del other
+    JeevesLib.unpin_viewer()
+    JeevesLib.collect()
+    c.name = 'testpin4'
+    c.save()
+    rows = AnimalWithPolicy._objects_ordinary.filter(jeeves_id=jeeves_id)
+    self.assertTrue(areRowsEqual(rows, [
+      ({'name':'testpin2', 'sound':'purr'}, {name:True}),
+      ({'name':'testpin4', 'sound':''}, {name:False}),
+     ]))
+
+  def testScopeMiddleware(self):
+    class Request(object):
+      pass
+    middleware = JeevesScopeMiddleware()
+    request = Request()
+    middleware.process_request(request)
+    awp = AnimalWithPolicy.objects.create(name='testpolicy4', sound='meow')
+    name = 'AnimalWithPolicy__sound__' + awp.jeeves_id
+    self.assertTrue(JeevesLib.doesLabelExist(name))
+    self.assertEqual(middleware.process_response(request, 'response'),
+      'response')
+    self.assertFalse(JeevesLib.doesLabelExist(name))
+    self.assertEqual(JeevesLib.jeevesState.scopes, [])
+
+  def testScopeMiddlewareErrors(self):
+    class Request(object):
+      pass
+    middleware = JeevesScopeMiddleware()
+
+    # The view raises.
+    middleware.process_request(Request())
+    self.assertEqual(len(JeevesLib.jeevesState.scopes), 1)
+    self.assertEqual(
+      middleware.process_exception(Request(), ValueError()), None)
+    self.assertEqual(JeevesLib.jeevesState.scopes, [])
+
+    # The response middleware is skipped: the next request closes the scope,
+    # and the ones left open in it.
+    middleware.process_request(Request())
+    x = JeevesLib.mkLabel('leaked')
+    JeevesLib.jeevesState.pushScope()
+    middleware.process_request(Request())
+    self.assertEqual(len(JeevesLib.jeevesState.scopes), 1)
+    self.assertFalse(JeevesLib.doesLabelExist(x.name))
+    middleware.process_response(Request(), 'response')
+    self.assertEqual(JeevesLib.jeevesState.scopes, [])
+
+  def testLabelCacheAcrossRequests(self):
+    jeeves_id = AnimalWithPolicy.objects.create(
+      name='testcache', sound='meow').jeeves_id
+    viewer = AnimalWithPolicy._objects_ordinary.filter(jeeves_id=jeeves_id)[0]
+    JeevesLib.collect()
+    JeevesLib.setViewerKey(lambda ctxt: ctxt.jeeves_id)
+    class Request(object):
+      pass
+    middleware = JeevesScopeMiddleware()
+
+    # Each request makes the label of the row again, and the second one
+    # decides it from the cache.
+    for hits in (0, 1):
+      request = Request()
+      middleware.process_request(request)
+      a = AnimalWithPolicy.objects.get(name='testcache')
+      self.assertEqual(JeevesLib.concretize(viewer, a.sound), 'meow')
+      self.assertEqual(JeevesLib.labelCacheStats()['hits'], hits)
+      middleware.process_response(request, 'response')
+
+    # Policies without a cache key are called again in each request.
+    AnimalWithPolicy2.objects.create(name='testnokey', sound='woof')
+    JeevesLib.collect()
+    for _ in range(2):
+      request = Request()
+      middleware.process_request(request)
+      a = AnimalWithPolicy2.objects.get(name='testnokey')
+      self.assertEqual(JeevesLib.concretize(viewer, a.sound), '')
+      self.assertEqual(JeevesLib.labelCacheStats()['hits'], 1)
+      middleware.process_response(request, 'response')
@@ -1,9 +1,13 @@
 import unittest
+import sys
+from decimal import Decimal
 import macropy.activate
 
 import JeevesLib
 from fast.AST import *
 from eval.Eval import partialEval
+from env.PathVars import emptyEnv
+import eval.Eval as Eval
 from JeevesLib import PositiveVariable, NegativeVariable
 
 def isPureFacetTree(f):
@@ -231,3 +235,308 @@ class TestAST(unittest.TestCase):
         self.assertEqual(ap.eval({l1:False, l2:False}), 1010)
 
 
+    def testHashcons(self):
+        JeevesLib.init()
+
+        l = Var("l")
+        a = hashcons(Facet(l, Constant(1), Constant(2)))
+        b = hashcons(Facet(l, Constant(1), Constant(2)))
+        self.assertTrue(a is b)
+        self.assertTrue(a.thn is mkConstant(1))
+        self.assertTrue(a.structEq(Facet(l, 1, 2)))
+        self.assertFalse(a.structEq(Facet(l, 2, 1)))
+
+        # Constants of different types are not merged.
+        self.assertFalse(mkConstant(1) is mkConstant(True))
+        self.assertFalse(mkConstant(1) is mkConstant(1.0))
+        # Nor equal values that are not the same value.
+        self.assertFalse(mkConstant(0.0) is mkConstant(-0.0))
+        self.assertTrue(mkConstant(0.5) is mkConstant(0.5))
+        self.assertFalse(mkConstant(Decimal('1.0')) is
+                         mkConstant(Decimal('1.00')))
+        self.assertFalse(mkConstant((1,)) is mkConstant((1,)))
+        self.assertEqual(str(hashcons(Constant(Decimal('1.00'))).v), '1.00')
+
+        # Structural keys can be used as dictionary keys.
+        d = {a.structKey(): 'a'}
+        self.assertEqual(d[hashcons(Facet(l, 1, 2)).structKey()], 'a')
+
+        # partialEval shares the facet it builds for a bare label.
+        self.assertTrue(partialEval(l) is partialEval(l))
+        ap = partialEval(Add(Facet(l, 1, 2), Facet(l, 10, 20)))
+        self.assertTrue(ap is partialEval(Add(Facet(l, 1, 2), Facet(l, 10, 20))))
+        self.assertEqual(ap.eval({l:True}), 11)
+        self.assertEqual(ap.eval({l:False}), 22)
+
+    def testFacetJoinPrunesDecidedLabels(self):
+        JeevesLib.init()
+
+        l = Var("l")
+        ap = partialEval(Add(Facet(l, 1, 10), Facet(l, 100, 1000)))
+        self.assertTrue(isinstance(ap.thn, Constant))
+        self.assertTrue(isinstance(ap.els, Constant))
+        self.assertEqual(ap.eval({l:True}), 101)
+        self.assertEqual(ap.eval({l:False}), 1010)
+
+    def testOrderedFacets(self):
+        JeevesLib.init()
+
+        l1 = Var("l1")
+        l2 = Var("l2")
+        Eval.setOrderedFacets(True)
+        try:
+            # The same function built in two different orders.
+            a = partialEval(Facet(l2, Facet(l1, 1, 2), Facet(l1, 3, 4)))
+            b = partialEval(Facet(l1, Facet(l2, 1, 3), Facet(l2, 2, 4)))
+            self.assertTrue(a is b)
+            self.assertTrue(Eval.facetEquals(Facet(l1, l2, False),
+                                             And(l2, l1)))
+            self.assertFalse(Eval.facetEquals(Facet(l1, l2, False), l1))
+
+            # Redundant tests are removed.
+            c = partialEval(Facet(l1, Facet(l1, 1, 2), Facet(l2, 3, 3)))
+            self.assertEqual(c.prettyPrint(), "< v%s ? const:1 : const:3 >"
+                             % l1.name[1:])
+
+            ap = partialEval(Add(Facet(l2, 1, 10), Facet(l1, 100, 1000)))
+            for v1 in (True, False):
+                for v2 in (True, False):
+                    self.assertEqual(ap.eval({l1:v1, l2:v2}),
+                        (1 if v2 else 10) + (100 if v1 else 1000))
+        finally:
+            Eval.setOrderedFacets(False)
+
+    def testCachedVars(self):
+        JeevesLib.init()
+
+        l1 = Var("l1")
+        l2 = Var("l2")
+        a = Add(Facet(l1, 1, 2), Facet(l2, Constant(3), Not(l1)))
+        vs = a.vars()
+        self.assertEqual(vs, frozenset([l1, l2]))
+        self.assertTrue(a.vars() is vs)
+        self.assertTrue(a.dependsOn(l2))
+        self.assertFalse(Facet(l1, 1, 2).dependsOn(l2))
+        self.assertTrue(Add(Constant(1), Constant(2)).isLabelFree())
+        self.assertFalse(a.isLabelFree())
+
+        # Lists can change, so their labels are not cached.
+        x = JeevesLib.mkLabel("x")
+        lst = JeevesLib.JList2([])
+        f = Facet(l1, FObject(lst), FObject(lst))
+        self.assertEqual(f.vars(), frozenset([l1]))
+        with PositiveVariable(x):
+            lst.append(1)
+        self.assertEqual(f.vars(), frozenset([l1, x]))
+
+    def testCompileExpr(self):
+        JeevesLib.init()
+
+        l1 = Var("l1")
+        l2 = Var("l2")
+        shared = Facet(l2, Constant(3), Constant(4))
+        exprs = [ Add(Facet(l1, 1, 2), shared)
+                , Mult(shared, Sub(shared, Facet(l1, 10, 20)))
+                , And(l1, Or(Not(l2), Facet(l1, l2, False)))
+                , Implies(l1, Eq(Facet(l2, 1, 2), Constant(1)))
+                , Facet(l1, Unassigned("x"), Facet(l2, 5, 6)) ]
+        for e in exprs:
+            f = compileExpr(e)
+            self.assertTrue(compileExpr(e) is f)
+            for v1 in (True, False):
+                for v2 in (True, False):
+                    env = {l1:v1, l2:v2}
+                    if isinstance(e, Facet) and v1:
+                        self.assertRaises(Exception, f, env)
+                    else:
+                        self.assertEqual(f(env), e.eval(env))
+
+        # Deep expressions are split into functions of bounded nesting.
+        e = Constant(0)
+        for i in xrange(3000):
+            e = Facet(l1, Add(e, Constant(1)), Constant(-1))
+        self.assertEqual(compileExpr(e)({l1:True}), 3000)
+        self.assertEqual(compileExpr(e)({l1:False}), -1)
+
+        # Facets switch to the compiled version once they are hot.
+        a = Facet(l1, 1, Facet(l2, 2, 3))
+        for i in xrange(COMPILE_THRESHOLD + 1):
+            self.assertEqual(a.eval({l1:False, l2:False}), 3)
+        self.assertTrue('_compiled' in a.__dict__)
+
+    def testEvalBatch(self):
+        JeevesLib.init()
+
+        l1 = Var("l1")
+        l2 = Var("l2")
+        exprs = [ Add(Facet(l1, 1, 2), Facet(l2, 3, 4))
+                , Div(Facet(l1, 7, -7), Facet(l2, 2, 3))
+                , Mult(Facet(l1, True, 2.5), Facet(l2, True, 2))
+                , And(l1, Or(Not(l2), Facet(l1, l2, False)))
+                , Implies(l1, Eq(Facet(l2, 1, 2), Constant(1)))
+                , Lt(Facet(l1, "a", "b"), Constant("b"))
+                , Mod(Facet(l1, "%s!", "x%d"), Facet(l2, 0, 1))
+                , Facet(l1, FObject([1, 2]), Facet(l2, 5, 6)) ]
+        assignments = [{l1:v1, l2:v2} for v1 in (True, False)
+                                      for v2 in (True, False)] * 3
+        exprs += [ Mult(Facet(l1, 2 ** 40, 3), Constant(2 ** 40))
+                 , Add(Facet(l1, 2 ** 62, 1), Constant(2 ** 62))
+                 , Sub(Constant(-2 ** 63), Facet(l2, 1, 0))
+                 , LShift(Constant(1), Facet(l1, 70, 3))
+                 , Add(Facet(l1, True, 2), Constant(1)) ]
+        for e in exprs:
+            values = JeevesLib.evalBatch(e, assignments)
+            expected = [e.eval(env) for env in assignments]
+            self.assertEqual(values, expected)
+            self.assertEqual(map(type, values), map(type, expected))
+
+        # Labels with the same name are still told apart.
+        x1 = Var("x", uniquify=False)
+        x2 = Var("x", uniquify=False)
+        e = Add(Facet(x1, 1, 2), Facet(x2, 10, 20))
+        self.assertEqual(JeevesLib.evalBatch(e, [{x1:True, x2:False}]), [21])
+
+        # Branches no assignment reaches are never evaluated.
+        e = Facet(l1, Unassigned("x"), Add(Facet(l2, 5, 6), Constant(1)))
+        self.assertEqual(JeevesLib.evalBatch(e, [{l1:False, l2:True}]), [6])
+        self.assertRaises(Exception, JeevesLib.evalBatch, e, [{l1:True}])
+        self.assertRaises(ZeroDivisionError, JeevesLib.evalBatch,
+                          Div(Constant(1.0), Facet(l1, 0.0, 1.0)),
+                          [{l1:True}])
+
+    def testBitEnv(self):
+        JeevesLib.init()
+        from env.PathVars import BitEnv, PathVars
+
+        l1 = Var("l1")
+        l2 = Var("l2")
+        # Labels with the same name share an id.
+        self.assertEqual(get_var_by_name(l1.name).id, l1.id)
+        self.assertNotEqual(l1.id, l2.id)
+
+        env = BitEnv().assign(l1, True).assign(l2, False)
+        self.assertTrue(env.has(l1) and env.get(l1))
+        self.assertTrue(env.has(l2) and not env.get(l2))
+        self.assertEqual(env.toDict(), {l1.name: True, l2.name: False})
+        self.assertEqual(BitEnv.fromDict(env.toDict()).decided, env.decided)
+        # Names no label has are left out, without taking an id.
+        ids = len(labelIds)
+        self.assertEqual(BitEnv.fromDict({'no such label': True}).decided, 0)
+        self.assertEqual(len(labelIds), ids)
+        self.assertTrue(l1.name in env)
+        self.assertFalse(env[l2.name])
+        self.assertEqual(len(env), 2)
+        self.assertFalse(BitEnv().has(l1))
+
+        e = Facet(l1, Facet(l2, 1, 2), 3)
+        self.assertEqual(partialEval(e, env).v, 2)
+        self.assertEqual(partialEval(e, {l1.name: True, l2.name: True}).v, 1)
+
+        pv = PathVars()
+        pv.push(l1, True)
+        pv.push(l2, False)
+        self.assertTrue(pv.hasPosVar(l1) and pv.hasNegVar(l2))
+        self.assertFalse(pv.hasNegVar(l1) or pv.hasPosVar(l2))
+        self.assertRaises(Exception, pv.push, l1, False)
+        pv.pop()
+        self.assertFalse(pv.hasNegVar(l2))
+        self.assertEqual(pv.getBitEnv().toDict(), pv.getEnv())
+
+    def testPartialEvalDeep(self):
+        JeevesLib.init()
+
+        import sys
+        n = sys.getrecursionlimit() * 2
+        labels = [Var("d") for _ in xrange(n)]
+        f = Constant(0)
+        for i, l in enumerate(labels):
+            f = Facet(l, Constant(i), f)
+        a = partialEval(Add(f, Constant(1)))
+        self.assertTrue(a.thn is mkConstant(n))
+        a = partialEval(f, {labels[-1].name: False, labels[-2].name: True})
+        self.assertTrue(a is mkConstant(n - 2))
+
+        # Unassigned values are kept or rejected as before.
+        u = Unassigned("u")
+        self.assertTrue(partialEval(Facet(labels[0], u, 1), {}, True).thn is u)
+        self.assertRaises(Exception, partialEval, Facet(labels[0], u, 1))
+
+    def testEvalCache(self):
+        JeevesLib.init()
+
+        l1 = Var("l1")
+        l2 = Var("l2")
+        l3 = Var("l3")
+        e = Add(Facet(l1, 1, 2), Facet(l2, 10, 20))
+        a = partialEval(e, {l1.name: True})
+        stats = JeevesLib.evalCacheStats()
+        # Labels the expression does not mention do not matter.
+        self.assertTrue(partialEval(e, {l1.name: True, l3.name: False}) is a)
+        self.assertEqual(JeevesLib.evalCacheStats()['hits'], stats['hits'] + 1)
+        self.assertTrue(partialEval(e, {l1.name: False}) is not a)
+        self.assertEqual(a.thn.v, 11)
+
+        # The results match the uncached ones.
+        Eval.setEvalCaching(False)
+        try:
+            self.assertTrue(partialEval(e, {l1.name: True}) is a)
+        finally:
+            Eval.setEvalCaching(True)
+
+        # Results built without facet simplification are kept apart.
+        Eval.setSimplifyFacets(False)
+        try:
+            stats = JeevesLib.evalCacheStats()
+            partialEval(e, {l1.name: True})
+            self.assertEqual(JeevesLib.evalCacheStats()['hits'], stats['hits'])
+        finally:
+            Eval.setSimplifyFacets(True)
+
+        JeevesLib.clearEvalCache()
+        self.assertEqual(JeevesLib.evalCacheStats()['size'], 0)
+        self.assertEqual(e.labelMask(), (1 << l1.id) | (1 << l2.id))
+
+    def testSimplifyFacets(self):
+        JeevesLib.init()
+        create_facet = Eval.create_facet
+
+        c = Var("c")
+        d = Var("d")
+        Eval.resetSimplifyStats()
+        a = create_facet(c, Facet(c, 1, 2), Constant(3))
+        self.assertTrue(a.thn is mkConstant(1))
+        a = create_facet(c, Facet(d, Facet(c, 1, Unassigned("u")), 4), Constant(3))
+        self.assertTrue(a.thn.thn is mkConstant(1))
+        a = create_facet(c, Facet(d, 1, 2), Facet(d, 1, 2))
+        self.assertTrue(a is hashcons(Facet(d, 1, 2)))
+        self.assertTrue(create_facet(c, Constant(5), Constant(5)) is mkConstant(5))
+        self.assertTrue(create_facet(c, Constant(5), Constant(5.0)) is mkConstant(5))
+        self.assertEqual(Eval.getSimplifyStats(),
+            {'nested': 2, 'unassigned': 1, 'merged': 2, 'constant': 1})
+
+        # Branches deeper than the recursion limit are fine.
+        deep = Constant(0)
+        for i in xrange(sys.getrecursionlimit() + 100):
+            deep = Facet(d, deep, Constant(i))
+        a = create_facet(c, deep, Constant(3))
+        self.assertTrue(a.thn.els is mkConstant(sys.getrecursionlimit() + 99))
+
+        # Unassigned values the path makes unreachable are dropped.
+        Eval.resetSimplifyStats()
+        env = emptyEnv.assign(d, True)
+        a = create_facet(c, Facet(d, 1, Unassigned("u")), Constant(3), env)
+        self.assertTrue(a.thn is mkConstant(1))
+        self.assertEqual(Eval.getSimplifyStats()['unassigned'], 1)
+
+        x = Facet(d, 1, Unassigned("u"))
+        with PositiveVariable(d):
+            a = JeevesLib.jif(c, lambda: x, lambda: 3)
+        self.assertTrue(a.thn is mkConstant(1))
+        self.assertEqual(Eval.getSimplifyStats()['unassigned'], 2)
+
+        Eval.setSimplifyFacets(False)
+        try:
+            a = create_facet(c, Facet(c, 1, 2), Constant(3))
+            self.assertTrue(isinstance(a.thn, Facet))
+        finally:
+            Eval.setSimplifyFacets(True)
@@ -6,8 +6,13 @@ the jifs should be gone. It would also
 '''
 #import macropy.activate
 import JeevesLib
+import fast.AST
 from smt.Z3 import *
+from smt.SMT import UnsatisfiableException
 import unittest
+import gc
+import thread
+import threading
 from JeevesLib import PositiveVariable, NegativeVariable
 
 class TestJeevesConfidentiality(unittest.TestCase):
@@ -629,5 +634,434 @@ class TestJeevesConfidentiality(unittest.TestCase):
     self.assertEqual(JeevesLib.concretize(False, l[3]), 6)
     self.assertEqual(JeevesLib.concretize(False, l[4]), 11)
 
+  def test_only_relevant_policies_evaluated(self):
+    calls = []
+    def policy(name, result):
+      def p(ctxt):
+        calls.append(name)
+        return result(ctxt)
+      return p
+    x = JeevesLib.mkLabel('x')
+    y = JeevesLib.mkLabel('y')
+    z = JeevesLib.mkLabel('z')
+    JeevesLib.restrict(x, policy('x', lambda _: y))
+    JeevesLib.restrict(y, policy('y', lambda ctxt: ctxt == 1))
+    JeevesLib.restrict(z, policy('z', lambda _: False))
+
+    state = JeevesLib.jeevesState.policyenv.getNewSolverState(1)
+    value = JeevesLib.mkSensitive(x, 1, 0)
+    self.assertEqual(state.concretizeExp(value, {}), 1)
+    self.assertEqual(sorted(calls), ['x', 'y'])
+    # Policies become relevant when a later value mentions their label.
+    self.assertEqual(state.concretizeExp(JeevesLib.mkSensitive(z, 1, 0), {}), 0)
+    self.assertEqual(sorted(calls), ['x', 'y', 'z'])
+
+  def test_restrict_in_policy(self):
+    x = JeevesLib.mkLabel('x')
+    def policy(ctxt):
+      y = JeevesLib.mkLabel('y')
+      JeevesLib.restrict(y, lambda _: False)
+      return y
+    JeevesLib.restrict(x, policy)
+    v = JeevesLib.mkSensitive(x, 'secret', 'public')
+    self.assertEqual(JeevesLib.concretize(None, v), 'public')
+    self.assertEqual(JeevesLib.concretizeAsync(None, v).get(), 'public')
+
+  def test_resolve_without_solver(self):
+    x = JeevesLib.mkLabel('x')
+    y = JeevesLib.mkLabel('y')
+    z = JeevesLib.mkLabel('z')
+    JeevesLib.restrict(x, lambda ctxt: JeevesLib.jand(lambda: y, lambda: ctxt > 0))
+    JeevesLib.restrict(y, lambda ctxt: ctxt < 5)
+    JeevesLib.restrict(z, lambda _: x)
+
+    for ctxt, expected in ((1, 1), (0, 0), (7, 0)):
+      state = JeevesLib.jeevesState.policyenv.getNewSolverState(ctxt)
+      value = JeevesLib.mkSensitive(z, 1, 0)
+      self.assertEqual(state.concretizeExp(value, {}), expected)
+      self.assertTrue(state.solver is None)
+
+  def test_resolve_cycle_with_solver(self):
+    x = JeevesLib.mkLabel('x')
+    y = JeevesLib.mkLabel('y')
+    z = JeevesLib.mkLabel('z')
+    JeevesLib.restrict(x, lambda _: y)
+    JeevesLib.restrict(y, lambda _: x)
+    JeevesLib.restrict(z, lambda _: JeevesLib.jnot(x))
+
+    state = JeevesLib.jeevesState.policyenv.getNewSolverState(None)
+    value = JeevesLib.mkSensitive(x, 1, 0)
+    self.assertEqual(state.concretizeExp(value, {}), 1)
+    self.assertTrue(state.solver is not None)
+    self.assertEqual(state.concretizeExp(JeevesLib.mkSensitive(z, 1, 0), {}), 0)
+
+  def test_resolved_labels_left_to_solver(self):
+    # x has no policy, so the resolver makes it HIGH, but y can only be HIGH
+    # with x LOW.
+    x = JeevesLib.mkLabel('x')
+    y = JeevesLib.mkLabel('y')
+    z = JeevesLib.mkLabel('z')
+    JeevesLib.restrict(y, lambda _: JeevesLib.jnot(x))
+    JeevesLib.restrict(z, lambda _: JeevesLib.jand(lambda: x, lambda: y))
+
+    value = JeevesLib.mkSensitive(y, 'y', '-') + \
+      JeevesLib.mkSensitive(z, 'z', '-')
+    self.assertEqual(JeevesLib.concretize(None, value), 'y-')
+
+  def test_optimize_resolution(self):
+    labels = [JeevesLib.mkLabel('l') for _ in xrange(8)]
+    for prev, label in zip(labels, labels[1:]):
+      JeevesLib.restrict(label, lambda _, prev=prev: JeevesLib.jnot(prev))
+    value = reduce(lambda a, b: a + b,
+                   [JeevesLib.mkSensitive(l, 1, 0) for l in labels])
+
+    policyenv = JeevesLib.jeevesState.policyenv
+    expected = policyenv.getNewSolverState(None).concretizeExp(value, {})
+    policyenv.setResolution('optimize')
+    state = policyenv.getNewSolverState(None)
+    self.assertEqual(state.concretizeExp(value, {}), expected)
+    self.assertTrue(state.solver.checks <= 3)
+
+  def test_solver_pool(self):
+    x = JeevesLib.mkLabel('x')
+    y = JeevesLib.mkLabel('y')
+    JeevesLib.restrict(x, lambda _: JeevesLib.jnot(y))
+    JeevesLib.restrict(y, lambda _: JeevesLib.jnot(x))
+    pool = JeevesLib.jeevesState.solverpool
+
+    v = JeevesLib.mkSensitive(x, 1, 0) + JeevesLib.mkSensitive(y, 10, 0)
+    self.assertTrue(JeevesLib.concretize(None, v) in (1, 10))
+    self.assertTrue(JeevesLib.concretize(None, v) in (1, 10))
+    self.assertEqual(pool.stats()['created'], 1)
+    self.assertEqual(pool.stats()['reused'], 1)
+    self.assertEqual(pool.free[0].scopes, 0)
+    self.assertEqual(len(pool.free[0].solver.assertions()), 0)
+
+    # A solver released after a failure is reset.
+    state = JeevesLib.jeevesState.policyenv.getNewSolverState(None)
+    state.concretizeExp(v, {})
+    state.solver.solverAssert(False)
+    state.solver.push()
+    state.release(True)
+    self.assertEqual(pool.free[0].scopes, 0)
+    self.assertEqual(len(pool.free[0].solver.assertions()), 0)
+
+  def test_label_cache(self):
+    calls = []
+    def policy(ctxt):
+      calls.append(ctxt)
+      return ctxt > 0
+    x = JeevesLib.mkLabel('x')
+    JeevesLib.restrict(x, policy)
+    JeevesLib.setViewerKey(lambda ctxt: ctxt)
+    v = JeevesLib.mkSensitive(x, 1, 0)
+
+    self.assertEqual(JeevesLib.concretize(1, v), 1)
+    self.assertEqual(JeevesLib.concretize(1, v), 1)
+    self.assertEqual(JeevesLib.concretize(0, v), 0)
+    self.assertEqual(calls, [1, 0])
+    self.assertEqual(JeevesLib.labelCacheStats()['hits'], 1)
+
+    # A new policy changes the version.
+    JeevesLib.restrict(x, lambda ctxt: ctxt > 1)
+    self.assertEqual(JeevesLib.concretize(1, v), 0)
+
+    # The cache is not used under a path condition.
+    with PositiveVariable(x):
+      self.assertEqual(JeevesLib.concretize(2, v), 1)
+    self.assertEqual(JeevesLib.concretize(2, v), 1)
+
+  def test_label_cache_across_scopes(self):
+    calls = []
+    state = {'public': True, 'version': 0}
+    def request(viewer, policyKey=None):
+      with JeevesLib.scope():
+        x = JeevesLib.mkLabel('row', uniquify=False)
+        JeevesLib.restrict(x,
+          lambda ctxt: calls.append(ctxt) or (state['public'] and ctxt > 0),
+          policyKey=policyKey)
+        return JeevesLib.concretize(viewer, JeevesLib.mkSensitive(x, 1, 0))
+    JeevesLib.setViewerKey(lambda ctxt: ctxt)
+
+    # Without a key, the policy is called again, and sees the new state.
+    self.assertEqual(request(1), 1)
+    state['public'] = False
+    self.assertEqual(request(1), 0)
+    self.assertEqual(calls, [1, 1])
+
+    # A label made again with the same name and keys is cached.
+    del calls[:]
+    state['public'] = True
+    key = lambda: state['version']
+    self.assertEqual([request(1, key()), request(1, key()), request(0, key())],
+      [1, 1, 0])
+    self.assertEqual(calls, [1, 0])
+    state['public'] = False
+    state['version'] += 1
+    self.assertEqual(request(1, key()), 0)
+    JeevesLib.invalidatePolicies('row')
+    self.assertEqual(request(1, key()), 0)
+    self.assertEqual(calls, [1, 0, 1, 1])
+
+  def test_label_components(self):
+    calls = []
+    def policy(ctxt):
+      calls.append(ctxt)
+      return ctxt > 0
+    x = JeevesLib.mkLabel('x')
+    y = JeevesLib.mkLabel('y')
+    z = JeevesLib.mkLabel('z')
+    JeevesLib.restrict(x, lambda _: JeevesLib.jnot(y))
+    JeevesLib.restrict(y, lambda _: JeevesLib.jnot(x))
+    JeevesLib.restrict(z, policy)
+    JeevesLib.setViewerKey(lambda ctxt: ctxt)
+
+    # Deciding y decides x too, so that the cached labels agree.
+    self.assertEqual(JeevesLib.concretize(1, JeevesLib.mkSensitive(y, 1, 0)), 1)
+    self.assertEqual(JeevesLib.concretize(1, JeevesLib.mkSensitive(x, 1, 0)), 0)
+    v = JeevesLib.mkSensitive(x, 1, 0) + JeevesLib.mkSensitive(z, 10, 0)
+    self.assertEqual(JeevesLib.concretize(1, v), 10)
+    self.assertEqual(JeevesLib.componentStats()['largest'], 2)
+
+    # A new policy only misses the cache for its own component, where x is
+    # now decided first.
+    JeevesLib.restrict(x, lambda _: True)
+    self.assertEqual(JeevesLib.concretize(1, v), 11)
+    self.assertEqual(calls, [1])
+
+  def test_pin_viewer(self):
+    x = JeevesLib.mkLabel('x')
+    y = JeevesLib.mkLabel('y')
+    z = JeevesLib.mkLabel('z')
+    JeevesLib.restrict(x, lambda ctxt: ctxt == 1)
+    JeevesLib.restrict(y, lambda _: JeevesLib.jnot(z))
+    JeevesLib.restrict(z, lambda _: JeevesLib.jnot(y))
+    JeevesLib.pin_viewer(1)
+
+    a = JeevesLib.mkSensitive(x, 'high', 'low')
+    self.assertEqual(a.v, 'high')
+    # Labels that depend on each other stay faceted.
+    b = JeevesLib.mkSensitive(y, 1, 0) + JeevesLib.mkSensitive(z, 10, 0)
+    self.assertTrue(isinstance(b, fast.AST.FExpr) and b.vars())
+    self.assertTrue(JeevesLib.concretize(1, b) in (1, 10))
+
+    self.assertRaises(JeevesLib.PinnedViewerException,
+      JeevesLib.concretize, 2, a)
+    self.assertRaises(JeevesLib.PinnedViewerException,
+      JeevesLib.restrict, x, lambda ctxt: ctxt == 2)
+    JeevesLib.restrict(x, lambda ctxt: ctxt > 0)
+
+    # A pin made in a scope ends with it.
+    JeevesLib.unpin_viewer()
+    with JeevesLib.scope():
+      JeevesLib.pin_viewer(2)
+      self.assertEqual(JeevesLib.mkSensitive(x, 'high', 'low').v, 'low')
+    v = JeevesLib.mkSensitive(x, 'high', 'low')
+    self.assertEqual(JeevesLib.concretize(1, v), 'high')
+    self.assertEqual(JeevesLib.concretize(2, v), 'low')
+
+  def test_policy_memo(self):
+    calls = []
+    def policy(ctxt):
+      calls.append(ctxt)
+      return ctxt > 0
+    x = JeevesLib.mkLabel('x')
+    JeevesLib.restrict(x, policy)
+    JeevesLib.setViewerKey(lambda ctxt: ctxt)
+    JeevesLib.setPolicyMemo()
+    v = JeevesLib.mkSensitive(x, 1, 0)
+
+    self.assertEqual(JeevesLib.concretize(1, v), 1)
+    # A new policy misses the label cache, but not the memo of the old one.
+    JeevesLib.restrict(x, lambda _: True)
+    self.assertEqual(JeevesLib.concretize(1, v), 1)
+    self.assertEqual(JeevesLib.concretize(0, v), 0)
+    self.assertEqual(calls, [1, 0])
+    self.assertEqual(JeevesLib.policyMemoStats(), {'saved': 1, 'labels': 1})
+
+    JeevesLib.invalidatePolicies(x.name)
+    self.assertEqual(JeevesLib.concretize(1, v), 1)
+    self.assertEqual(calls, [1, 0, 1])
+
+  def test_collect(self):
+    # A label only referred to by its own policy.
+    def mkSelfReferring():
+      x = JeevesLib.mkLabel('x')
+      JeevesLib.restrict(x, lambda ctxt: ctxt or x)
+      return x.name, x.id
+    name, xid = mkSelfReferring()
+    y = JeevesLib.mkLabel('y')
+    JeevesLib.restrict(y, lambda ctxt: ctxt)
+    v = JeevesLib.mkSensitive(y, 1, 0)
+    policyenv = JeevesLib.jeevesState.policyenv
+
+    self.assertTrue(JeevesLib.collect() >= 1)
+    self.assertFalse(JeevesLib.doesLabelExist(name))
+    self.assertEqual(fast.AST.labelIds.find(name), None)
+    self.assertEqual(len(policyenv.policies), 1)
+    self.assertEqual(JeevesLib.concretize(True, v), 1)
+    self.assertEqual(JeevesLib.concretize(False, v), 0)
+
+    # Freed ids are reused, smallest first.
+    self.assertTrue(JeevesLib.mkLabel('z').id <= xid)
+    self.assertTrue(JeevesLib.doesLabelExist(y.name))
+
+  def test_collect_base_env(self):
+    # The path a namespace is made on keeps its labels and their ids.
+    def mkNamespace():
+      x = JeevesLib.mkLabel('x')
+      with PositiveVariable(x):
+        return JeevesLib.Namespace({'v': 0}, 'f'), x.id
+    ns, xid = mkNamespace()
+    JeevesLib.collect()
+    # New labels take all the free ids, and none of them the one of x.
+    ys = [JeevesLib.mkLabel('y')
+      for _ in xrange(len(fast.AST.labelIds.free) + 1)]
+    self.assertFalse(any(y.id == xid for y in ys))
+    y = ys[-1]
+    JeevesLib.restrict(y, lambda ctxt: ctxt)
+    with PositiveVariable(y):
+      ns.v = 42
+    self.assertEqual(JeevesLib.concretize(False, ns.v), 0)
+    self.assertEqual(JeevesLib.concretize(True, ns.v), 42)
+
+  def test_scope(self):
+    x = JeevesLib.mkLabel('x')
+    JeevesLib.restrict(x, lambda ctxt: ctxt)
+    v = JeevesLib.mkSensitive(x, 1, 0)
+    outer = JeevesLib.jeevesState.policyenv
+
+    with JeevesLib.scope():
+      # The scope reads through to the enclosing policies.
+      self.assertEqual(JeevesLib.jeevesState.policyenv.policies, [])
+      y = JeevesLib.mkLabel('y')
+      JeevesLib.restrict(y, lambda ctxt: not ctxt)
+      z = JeevesLib.mkLabel('z')
+      JeevesLib.restrict(z, lambda ctxt: ctxt)
+      JeevesLib.promote(z)
+      # The enclosing labels and policies still apply.
+      self.assertTrue(JeevesLib.doesLabelExist(x.name))
+      self.assertEqual(JeevesLib.concretize(False, v), 0)
+      self.assertEqual(JeevesLib.concretize(False,
+        JeevesLib.mkSensitive(y, 1, 0)), 1)
+
+    self.assertTrue(JeevesLib.jeevesState.policyenv is outer)
+    self.assertEqual(len(outer.policies), 2)
+    self.assertFalse(JeevesLib.doesLabelExist(y.name))
+    self.assertTrue(JeevesLib.getLabel(z.name) is z)
+    self.assertEqual(JeevesLib.concretize(False,
+      JeevesLib.mkSensitive(z, 1, 0)), 0)
+
+  def test_thread_state_released(self):
+    results = []
+    def work():
+      x = JeevesLib.mkLabel('x')
+      JeevesLib.restrict(x, lambda ctxt: ctxt)
+      sizes = JeevesLib.threadStats()[thread.get_ident()]
+      results.append((JeevesLib.concretize(True,
+        JeevesLib.mkSensitive(x, 1, 0)), sizes['labels'], sizes['policies']))
+    JeevesLib.mkLabel('main')
+    for _ in xrange(20):
+      t = threading.Thread(target=work)
+      t.start()
+      t.join()
+    gc.collect()
+    self.assertEqual(results, [(1, 1, 1)] * 20)
+    self.assertEqual(JeevesLib.threadStats().keys(), [thread.get_ident()])
+
+  def test_concretize_parallel(self):
+    x = JeevesLib.mkLabel('x')
+    y = JeevesLib.mkLabel('y')
+    JeevesLib.restrict(x, lambda ctxt: ctxt % 2 == 0)
+    # Not monotone, so y is decided by the solver.
+    JeevesLib.restrict(y, lambda ctxt: JeevesLib.jnot(x))
+    v = JeevesLib.mkSensitive(x, 1, 0) + JeevesLib.mkSensitive(y, 10, 0)
+
+    requests = [(viewer, v) for viewer in range(8)]
+    self.assertEqual(JeevesLib.concretizeParallel(requests),
+      [JeevesLib.concretize(viewer, v) for viewer in range(8)])
+    self.assertEqual(JeevesLib.concretizeAsync(3, v).get(), 10)
+
+  def test_concretize_in_processes(self):
+    lst = JeevesLib.JList2()
+    for i in xrange(12):
+      a = JeevesLib.mkLabel('a')
+      b = JeevesLib.mkLabel('b')
+      JeevesLib.restrict(a, lambda ctxt, i=i: ctxt % 3 != i % 3)
+      # Not monotone, so the solver decides which of a and b is HIGH.
+      JeevesLib.restrict(b, lambda ctxt, a=a: JeevesLib.jnot(a))
+      with PositiveVariable(a):
+        lst.append(i)
+      with PositiveVariable(b):
+        lst.append(-i)
+    v = fast.AST.FObject(lst)
+    for viewer in xrange(3):
+      self.assertEqual(JeevesLib.concretizeInProcesses(viewer, v, 2),
+        JeevesLib.concretize(viewer, v))
+
+    # Both fail the same way under unsatisfiable constraints.
+    x = JeevesLib.mkLabel('x')
+    JeevesLib.restrict(x, lambda _: False)
+    JeevesLib.restrict(fast.AST.Not(x), lambda _: False)
+    v = JeevesLib.mkSensitive(x, 1, 0)
+    self.assertRaises(UnsatisfiableException, JeevesLib.concretize, 0, v)
+    self.assertRaises(UnsatisfiableException,
+      JeevesLib.concretizeInProcesses, 0, v, 2)
+
+  def test_labels_from_threads(self):
+    labels = []
+    def work():
+      labels.extend(JeevesLib.mkLabel('t') for _ in xrange(100))
+    threads = [threading.Thread(target=work) for _ in xrange(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(len(set(label.name for label in labels)), 400)
+    self.assertEqual(len(set(label.id for label in labels)), 400)
+
+  def test_concretize_many(self):
+    x = JeevesLib.mkLabel('x')
+    y = JeevesLib.mkLabel('y')
+    JeevesLib.restrict(x, lambda ctxt: ctxt == 'alice')
+    JeevesLib.restrict(y, lambda ctxt: x)
+    a = JeevesLib.mkSensitive(x, 'secret', 'public')
+    b = JeevesLib.mkSensitive(y, 1, 0)
+    shared = [a, b]
+    values = {'a': a, 'nested': {'pair': (a, b), 'list': shared},
+              'again': shared, 'plain': 7}
+
+    r = JeevesLib.concretizeMany('alice', values)
+    self.assertEqual(r['a'], 'secret')
+    self.assertEqual(r['nested']['pair'], ('secret', 1))
+    self.assertEqual(r['plain'], 7)
+    self.assertTrue(r['again'] is r['nested']['list'])
+    self.assertEqual(r['again'], ['secret', 1])
+    r = JeevesLib.concretizeMany('bob', values)
+    self.assertEqual(r['nested']['pair'], ('public', 0))
+
+  def test_concretize_for_viewers(self):
+    calls = []
+    def policy(ctxt):
+      calls.append(ctxt)
+      return ctxt % 2 == 0
+    x = JeevesLib.mkLabel('x')
+    y = JeevesLib.mkLabel('y')
+    JeevesLib.restrict(x, policy)
+    JeevesLib.restrict(y, lambda ctxt: JeevesLib.jnot(x))
+    v = JeevesLib.mkSensitive(x, 1, 0) + JeevesLib.mkSensitive(y, 10, 0)
+
+    viewers = range(6) + [2]
+    r = JeevesLib.concretizeForViewers(viewers, v)
+    self.assertEqual(sorted(calls), range(6))
+    for viewer in viewers:
+      self.assertEqual(r[viewer], JeevesLib.concretize(viewer, v))
+    # The two outcomes of the policy give two groups.
+    policyenv = JeevesLib.jeevesState.policyenv
+    states = [policyenv.getNewSolverState(viewer) for viewer in range(6)]
+    for state in states:
+      state.collect(v.vars(), {})
+    self.assertEqual(len(set(state.signature() for state in states)), 2)
+
 if __name__ == '__main__':
     unittest.main()